@@ -1,4 +1,27 @@
-from math import sqrt
+from math import sqrt, cos, sin, pi
+
+from numpy import (
+    array,
+    asarray,
+    ndarray,
+    hstack,
+    roll,
+    clip,
+    column_stack,
+    hypot,
+    maximum,
+    minimum,
+    vstack,
+    cumsum,
+    argsort,
+    inf,
+    broadcast_to,
+    empty,
+    flatnonzero,
+    where,
+    zeros,
+    errstate
+)
 
 from planar import Vec2
 from planar import BoundingBox
@@ -23,6 +46,19 @@ class Circle(object):
     def contains_point(self, point):
         return True if self.distance_to_edge(point) < 0 else False
 
+    def distances_to_edge(self, points):
+        points = vecs_to_array(points)
+        return hypot(points[:,0] - self.center.x, points[:,1] - self.center.y) - self.radius
+
+    def distances_to(self, points):
+        return maximum(self.distances_to_edge(points), 0)
+
+    def contains_points(self, points):
+        return self.distances_to_edge(points) < 0
+
+    def get_perimeter_points(self, count=16):
+        return [self.center + Vec2(self.radius*cos(2*pi*i/count), self.radius*sin(2*pi*i/count)) for i in range(count)]
+
 
 def ccw(A,B,C):
     ccw = (C.y-A.y)*(B.x-A.x) > (B.y-A.y)*(C.x-A.x)
@@ -92,13 +128,120 @@ def poly_to_vec_distance(poly, vec):
     return min(dists)
 
 
-def poly_to_seg_distance(poly, seg):
-    dists = []
+def vecs_to_array(vecs):
+    ''' Packs a sequence of Vec2 (or an existing array) into an (N,2) float array '''
+    if isinstance(vecs, ndarray):
+        return asarray(vecs, dtype=float).reshape(-1, 2)
+    return array([(v[0], v[1]) for v in vecs], dtype=float).reshape(-1, 2)
 
-    for edge in poly_to_edges(poly):
-        dists.append(  seg_to_seg_distance( edge, seg )  )
 
-    return min(dists)
+def poly_to_segs_array(vertices):
+    ''' (N,2) vertex array -> (N,4) array of closed edges as [x1,y1,x2,y2] '''
+    return hstack([vertices, roll(vertices, -1, axis=0)])
+
+
+def segs_to_vecs_distance(segs, points):
+    ''' (M,4) segment array, (N,2) point array -> (M,N) distance matrix '''
+    starts = segs[:,None,0:2]
+    vectors = segs[:,None,2:4] - starts
+    diffs = points[None,:,:] - starts
+
+    lengths2 = (vectors*vectors).sum(axis=2)
+    t = (diffs*vectors).sum(axis=2) / where(lengths2 > 0, lengths2, 1)
+    t = clip(t, 0, 1)
+
+    closest = starts + t[:,:,None]*vectors
+    return hypot(points[None,:,0] - closest[:,:,0], points[None,:,1] - closest[:,:,1])
+
+
+def poly_contains_vecs(vertices, points):
+    ''' Even-odd rule containment of an (N,2) point array in a polygon, returns boolean mask '''
+    x, y = points[:,0], points[:,1]
+    inside = zeros(len(points), dtype=bool)
+
+    with errstate(divide='ignore', invalid='ignore'):
+        for (ax,ay),(bx,by) in zip(vertices, roll(vertices, 1, axis=0)):
+            crosses = (ay > y) != (by > y)
+            xi = (bx - ax) * (y - ay) / (by - ay) + ax
+            inside ^= crosses & (x < xi)
+
+    return inside
+
+
+def poly_to_vecs_distance(poly, points):
+    ''' Batch poly_to_vec_distance, returns an array of N distances (0 inside the polygon) '''
+    return verts_to_vecs_distance(vecs_to_array(poly), points)
+
+
+def verts_to_vecs_distance(vertices, points, segs=None):
+    ''' poly_to_vecs_distance for an (N,2) vertex array and, optionally, its precomputed edges '''
+    points = vecs_to_array(points)
+    if segs is None: segs = poly_to_segs_array(vertices)
+
+    dists = segs_to_vecs_distance(segs, points).min(axis=0)
+    dists[poly_contains_vecs(vertices, points)] = 0
+    return dists
+
+
+def seg_to_vecs_distance(seg, points):
+    segs = array([[seg.start.x, seg.start.y, seg.end.x, seg.end.y]], dtype=float)
+    return segs_to_vecs_distance(segs, vecs_to_array(points))[0]
+
+
+def seg_project_vecs(seg, points):
+    ''' Batch LineSegment.project, returns an (N,2) array of closest points on the segment '''
+    points = vecs_to_array(points)
+    start = array([seg.start.x, seg.start.y])
+    vector = array([seg.end.x, seg.end.y]) - start
+
+    length2 = (vector*vector).sum()
+    if length2 == 0:
+        return zeros(points.shape) + start
+
+    t = clip(((points - start)*vector).sum(axis=1) / length2, 0, 1)
+    return start + t[:,None]*vector
+
+
+def vec_to_vecs_distance(vec, points):
+    points = vecs_to_array(points)
+    return hypot(points[:,0] - vec.x, points[:,1] - vec.y)
+
+
+def bb_to_vec_distance(bb, vec):
+    dx = max(bb.min_point.x - vec[0], vec[0] - bb.max_point.x, 0)
+    dy = max(bb.min_point.y - vec[1], vec[1] - bb.max_point.y, 0)
+    return sqrt(dx*dx + dy*dy)
+
+
+def bb_to_vecs_distance(bb, points):
+    ''' Closed-form distance from an axis-aligned box to an (N,2) point array (0 inside the box) '''
+    points = vecs_to_array(points)
+    dx = maximum(maximum(bb.min_point.x - points[:,0], points[:,0] - bb.max_point.x), 0)
+    dy = maximum(maximum(bb.min_point.y - points[:,1], points[:,1] - bb.max_point.y), 0)
+    return hypot(dx, dy)
+
+
+def bb_contains_vecs(bb, points):
+    ''' Batch BoundingBox.contains_point, returns a boolean mask '''
+    points = vecs_to_array(points)
+    return ((points[:,0] >= bb.min_point.x) & (points[:,0] < bb.max_point.x) &
+            (points[:,1] >= bb.min_point.y) & (points[:,1] < bb.max_point.y))
+
+
+def bb_project_vec(bb, vec):
+    return Vec2(min(max(vec[0], bb.min_point.x), bb.max_point.x),
+                min(max(vec[1], bb.min_point.y), bb.max_point.y))
+
+
+def bb_project_vecs(bb, points):
+    ''' Closest point of an axis-aligned box for each row of an (N,2) point array '''
+    points = vecs_to_array(points)
+    return column_stack([clip(points[:,0], bb.min_point.x, bb.max_point.x),
+                         clip(points[:,1], bb.min_point.y, bb.max_point.y)])
+
+
+def poly_to_seg_distance(poly, seg):
+    return segs_to_segs_min_distance(shape_to_segs_array(seg), shape_to_segs_array(poly))
 
 
 def bb_to_bb_distance(bb1, bb2):
@@ -106,7 +249,157 @@ def bb_to_bb_distance(bb1, bb2):
 
 
 def poly_to_poly_distance(poly1, poly2):
-    dists = []
-    for e1 in poly_to_edges(poly1):
-        dists.append(poly_to_seg_distance(poly2, e1))
-    return min(dists)
+    return segs_to_segs_min_distance(shape_to_segs_array(poly1), shape_to_segs_array(poly2))
+
+
+def shape_to_segs_array(shape):
+    ''' Encodes a Vec2, LineSegment, BoundingBox or Polygon as an (M,4) segment array '''
+    if isinstance(shape, BoundingBox):
+        return poly_to_segs_array(vecs_to_array(shape.to_polygon()))
+    elif isinstance(shape, LineSegment):
+        return array([[shape.start.x, shape.start.y, shape.end.x, shape.end.y]], dtype=float)
+    elif isinstance(shape, Vec2):
+        return array([[shape.x, shape.y, shape.x, shape.y]], dtype=float)
+    else:
+        return poly_to_segs_array(vecs_to_array(shape))
+
+
+def segs_ccw(A, B, C):
+    return (C[...,1]-A[...,1])*(B[...,0]-A[...,0]) > (B[...,1]-A[...,1])*(C[...,0]-A[...,0])
+
+
+def segs_intersect(segs1, segs2):
+    ''' Batch intersect, (M,4) and (K,4) segment arrays -> (M,K) boolean matrix '''
+    A, B = segs1[:,None,0:2], segs1[:,None,2:4]
+    C, D = segs2[None,:,0:2], segs2[None,:,2:4]
+    return (segs_ccw(A,C,D) != segs_ccw(B,C,D)) & (segs_ccw(A,B,C) != segs_ccw(A,B,D))
+
+
+def segs_to_segs_distance(segs1, segs2):
+    ''' Batch seg_to_seg_distance, (M,4) and (K,4) segment arrays -> (M,K) distance matrix '''
+    dists = minimum(minimum(segs_to_vecs_distance(segs1, segs2[:,0:2]),
+                            segs_to_vecs_distance(segs1, segs2[:,2:4])),
+                    minimum(segs_to_vecs_distance(segs2, segs1[:,0:2]).T,
+                            segs_to_vecs_distance(segs2, segs1[:,2:4]).T))
+    dists[segs_intersect(segs1, segs2)] = 0
+    return dists
+
+
+def segs_bounds(segs):
+    ''' (M,4) segment array -> [min_x, min_y, max_x, max_y] of all its segments '''
+    xs = segs[:,0::2]
+    ys = segs[:,1::2]
+    return array([xs.min(), ys.min(), xs.max(), ys.max()])
+
+
+def bounds_to_bounds_distance(bounds1, bounds2):
+    ''' (A,4) and (B,4) box arrays -> (A,B) matrix of box-to-box distances '''
+    b1 = bounds1[:,None,:]
+    b2 = bounds2[None,:,:]
+    dx = maximum(maximum(b1[...,0] - b2[...,2], b2[...,0] - b1[...,2]), 0)
+    dy = maximum(maximum(b1[...,1] - b2[...,3], b2[...,1] - b1[...,3]), 0)
+    return hypot(dx, dy)
+
+
+def shapes_to_shapes_distance(shapes1, shapes2):
+    ''' Lists of (M_i,4) segment arrays -> (A,B) matrix of shape-to-shape distances,
+        computed as a single batched segment-pair evaluation '''
+    segs1 = vstack(shapes1)
+    segs2 = vstack(shapes2)
+    starts1 = cumsum([0] + [len(s) for s in shapes1[:-1]])
+    starts2 = cumsum([0] + [len(s) for s in shapes2[:-1]])
+
+    dists = segs_to_segs_distance(segs1, segs2)
+    dists = minimum.reduceat(dists, starts1, axis=0)
+    return minimum.reduceat(dists, starts2, axis=1)
+
+
+def nearest_shapes(shapes1, shapes2):
+    ''' For every shape in shapes1 find the nearest shape in shapes2.
+        Candidates are visited in order of their bounding box distance, which is a lower
+        bound on the true distance, and skipped once they can't beat the current minimum.
+        Returns (distances, indices) arrays. '''
+    lower = bounds_to_bounds_distance(array([segs_bounds(s) for s in shapes1]),
+                                      array([segs_bounds(s) for s in shapes2]))
+
+    dists = zeros(len(shapes1)) + inf
+    indices = zeros(len(shapes1), dtype=int) - 1
+    for i,segs in enumerate(shapes1):
+        for j in argsort(lower[i]):
+            if lower[i,j] >= dists[i]: break
+            d = segs_to_segs_distance(segs, shapes2[j]).min()
+            if d < dists[i]:
+                dists[i] = d
+                indices[i] = j
+
+    return dists, indices
+
+
+def segs_to_segs_min_distance(segs1, segs2):
+    ''' Smallest distance between two (M,4) segment arrays. Each segment of segs2 is a
+        candidate shape of nearest_shapes, so the ones whose bounds are already farther
+        than the best distance are never evaluated '''
+    return nearest_shapes([segs1], [segs2[j:j+1] for j in range(len(segs2))])[0][0]
+
+
+# Kind codes of packed geometry, see packed_to_vecs_distance
+POINT, LINE, RECT, CIRCLE, POLYGON = range(5)
+
+
+def packed_to_vecs_distance(kinds, coords, starts, ends, vertices, points):
+    ''' Distances from R packed shapes to points, one kernel call per kind.
+        kinds (R,), coords (R,4) as [x,y,-,-] / [x1,y1,x2,y2] / [min_x,min_y,max_x,max_y] /
+        [cx,cy,radius,-] / polygon bounds, polygon vertices in vertices[starts[i]:ends[i]].
+        points is either shared (N,2) or per shape (R,N,2). Returns (R,N). '''
+    points = broadcast_to(points, (len(kinds),) + points.shape[-2:])
+    x, y = points[...,0], points[...,1]
+    dists = empty(x.shape)
+
+    rows = flatnonzero(kinds == POINT)
+    c = coords[rows,None,:]
+    dists[rows] = hypot(x[rows] - c[...,0], y[rows] - c[...,1])
+
+    rows = flatnonzero(kinds == LINE)
+    c = coords[rows,None,:]
+    vx, vy = c[...,2] - c[...,0], c[...,3] - c[...,1]
+    length2 = vx*vx + vy*vy
+    t = clip(((x[rows] - c[...,0])*vx + (y[rows] - c[...,1])*vy) / where(length2 > 0, length2, 1), 0, 1)
+    dists[rows] = hypot(x[rows] - c[...,0] - t*vx, y[rows] - c[...,1] - t*vy)
+
+    rows = flatnonzero(kinds == RECT)
+    c = coords[rows,None,:]
+    dx = maximum(maximum(c[...,0] - x[rows], x[rows] - c[...,2]), 0)
+    dy = maximum(maximum(c[...,1] - y[rows], y[rows] - c[...,3]), 0)
+    dists[rows] = hypot(dx, dy)
+
+    rows = flatnonzero(kinds == CIRCLE)
+    c = coords[rows,None,:]
+    dists[rows] = maximum(hypot(x[rows] - c[...,0], y[rows] - c[...,1]) - c[...,2], 0)
+
+    for row in flatnonzero(kinds == POLYGON):
+        dists[row] = verts_to_vecs_distance(vertices[starts[row]:ends[row]], points[row])
+
+    return dists
+
+
+def packed_project_vecs(kinds, coords, points):
+    ''' Batch my_project_points for R packed shapes, (N,2) or (R,N,2) points -> (R,N,2) '''
+    projected = array(broadcast_to(points, (len(kinds),) + points.shape[-2:]))
+
+    rows = flatnonzero(kinds == POINT)
+    projected[rows] = coords[rows,None,0:2]
+
+    rows = flatnonzero(kinds == LINE)
+    c = coords[rows,None,:]
+    start = c[...,0:2]
+    vector = c[...,2:4] - start
+    length2 = (vector*vector).sum(axis=2)
+    t = clip(((projected[rows] - start)*vector).sum(axis=2) / where(length2 > 0, length2, 1), 0, 1)
+    projected[rows] = start + t[...,None]*vector
+
+    rows = flatnonzero(kinds == RECT)
+    c = coords[rows,None,:]
+    projected[rows,:,0] = clip(projected[rows,:,0], c[...,0], c[...,2])
+    projected[rows,:,1] = clip(projected[rows,:,1], c[...,1], c[...,3])
+
+    return projected
@@ -7,6 +7,7 @@ from myrandom import random
 choice = random.choice
 
 import numpy as np
+from geometry import vecs_to_array
 
 
 class Color(object):
@@ -55,7 +56,6 @@ class Landmark(object):
         self.object_class = object_class
         self.color = color
         self.uuid = uuid4()
-        self.ori_relations = set()
 
         self.representation.parent_landmark = self
 
@@ -85,17 +85,10 @@ class Landmark(object):
         return self.get_top_parent().get_primary_axes()
 
     def distance_to(self, rep):
-        top_parent = self.get_top_parent()
-        min_dist = float('inf')
-
-        for p in rep.get_points():
-            tpd = top_parent.distance_to_point(p)
-            if self.parent: p = self.parent.project_point(p)
-            d = self.representation.distance_to_point(p)
-            d = np.sqrt( d*d + tpd*tpd )
-            if d < min_dist: min_dist = d
-
-        return min_dist
+        ''' Closest distance to rep, measured through rep.get_distance_points() '''
+        points, radius = rep.get_distance_points()
+        if len(points) == 0: return float('inf')
+        return max(self.distance_to_points(points).min() - radius, 0)
 
     def distance_to_point(self, p):
         top_parent = self.get_top_parent()
@@ -107,6 +100,14 @@ class Landmark(object):
 
         return d
 
+    def distance_to_points(self, points):
+        points = vecs_to_array(points)
+        top_parent = self.get_top_parent()
+        tpd = top_parent.distance_to_points(points)
+        if self.parent: points = self.parent.project_points(points)
+        d = self.representation.distance_to_points(points)
+        return np.sqrt( d*d + tpd*tpd )
+
     def get_top_parent(self):
         top = self.parent
         if top is None: return self.representation
@@ -89,7 +89,14 @@ phrase_to_class = {
 
 }
 
-def get_landmark_description(perspective, landmark, delimit_chunks=False):
+def get_ori_relations(perspective, landmark, orientations=None):
+    ''' Orientation modifiers of landmark, from an orientations dict (see Speaker.get_orientations)
+        if given, otherwise computed for perspective '''
+    if orientations is not None:
+        return orientations.get(landmark, [])
+    return OrientationRelationSet.get_orientation_modifiers(perspective, landmark)
+
+def get_landmark_description(perspective, landmark, delimit_chunks=False, orientations=None):
     noun = choice(class_to_words[landmark.object_class]['N']) + (' * ' if delimit_chunks else ' ')
     desc = 'the' + (' * ' if delimit_chunks else ' ')
 
@@ -100,13 +107,13 @@ def get_landmark_description(perspective, landmark, delimit_chunks=False):
     # ori,color,nounclass = do
 
     if ori:
-        for option in landmark.ori_relations:
+        for option in get_ori_relations(perspective, landmark, orientations):
             desc += choice( class_to_words[option]['A'] ) + (' * ' if delimit_chunks else ' ')
 
     desc += (choice(class_to_words[landmark.color]['A']) + ' ' if color and landmark.color else '') + (noun if nounclass else '')
 
     if landmark.parent and landmark.parent.parent_landmark:
-        p_desc = get_landmark_description(perspective, landmark.parent.parent_landmark)
+        p_desc = get_landmark_description(perspective, landmark.parent.parent_landmark, orientations=orientations)
         if p_desc:
             desc += 'of' + (' * ' if delimit_chunks else ' ') + p_desc
 
@@ -122,25 +129,25 @@ def get_relation_description(relation, delimit_chunks=False):
                 distance + ( (' * ' if delimit_chunks else ' ') if distance else '')
     return desc + choice(class_to_words[type(relation)]['P']) + (' * ' if delimit_chunks else ' ')
 
-def describe(perspective, trajector, landmark, relation, delimit_chunks=False):
+def describe(perspective, trajector, landmark, relation, delimit_chunks=False, orientations=None):
     # return 'The ' + \
     #        (choice(class_to_words[trajector.color]['A']) + ' ' if trajector.color else '') + \
     #        choice(class_to_words[trajector.object_class]['N']) + ' is' + \
     #        (' * ' if delimit_chunks else ' ') + \
     return get_relation_description(relation, delimit_chunks) + \
-           get_landmark_description(perspective, landmark, delimit_chunks)
+           get_landmark_description(perspective, landmark, delimit_chunks, orientations)
 
 
-def get_all_landmark_descriptions(perspective, trajector, landmark):
+def get_all_landmark_descriptions(perspective, trajector, landmark, orientations=None):
     lists = [['the','a']]
-    lists.extend([class_to_words[option]['A'] for option in landmark.ori_relations])
+    lists.extend([class_to_words[option]['A'] for option in get_ori_relations(perspective, landmark, orientations)])
     lists.append(class_to_words[landmark.color]['A'] if landmark.color else [])
     lists.append(class_to_words[landmark.object_class]['N'])
     lists = filter(None,lists)
 
     if landmark.parent and landmark.parent.parent_landmark:
         lists.append( ['of'] )
-        lists.append( get_all_landmark_descriptions(perspective, trajector, landmark.parent.parent_landmark) )
+        lists.append( get_all_landmark_descriptions(perspective, trajector, landmark.parent.parent_landmark, orientations) )
 
     return [' '.join(tup) for tup in product(*lists)]
 
@@ -158,8 +165,8 @@ def get_all_relation_descriptions(relation):
     return [' '.join(tup) for tup in product(*lists)]
 
 
-def get_all_descriptions(perspective, trajector, landmark, relation, the_point_is=False):
-    lmk_descs = get_all_landmark_descriptions(perspective, trajector, landmark)
+def get_all_descriptions(perspective, trajector, landmark, relation, the_point_is=False, orientations=None):
+    lmk_descs = get_all_landmark_descriptions(perspective, trajector, landmark, orientations)
     rel_descs = get_all_relation_descriptions(relation)
 
     return [' '.join(tup).strip() for tup in product(rel_descs, lmk_descs)]
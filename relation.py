@@ -4,12 +4,15 @@ from myrandom import random
 choice = random.choice
 
 from myrandom import nprandom as random
-from numpy import array, zeros, maximum
+from numpy import array, asarray, zeros, minimum, maximum, where, cumsum, vstack
+from numpy.random import RandomState
 from scipy.stats import norm
-from planar import Vec2, Affine
+from planar import Vec2, Affine, EPSILON
 from planar.line import LineSegment, Ray
+from landmark import Landmark
 from representation import PointRepresentation, SurfaceRepresentation
-from itertools import product
+from geometry import vecs_to_array
+from utils import LRUCache
 
 
 class Relation(object):
@@ -19,6 +22,21 @@ class Relation(object):
         self.trajector = trajector
 
 
+def trajectors_contained(landmark, trajectors):
+    ''' landmark.representation.contains(trajector.representation) for every trajector as a boolean array '''
+    if all(isinstance(trajector.representation, PointRepresentation) for trajector in trajectors):
+        return landmark.representation.contains_points( vecs_to_array([trajector.representation.location for trajector in trajectors]) )
+    return array([landmark.representation.contains(trajector.representation) for trajector in trajectors], dtype=bool)
+
+
+def trajector_distances(landmark, trajectors):
+    ''' landmark.distance_to(trajector.representation) for every trajector in one batch call '''
+    point_arrays, radii = zip(*[trajector.representation.get_distance_points() for trajector in trajectors])
+    distances = landmark.distance_to_points( vecs_to_array(vstack(point_arrays)) )
+    distances = minimum.reduceat(distances, cumsum([0] + [len(points) for points in point_arrays[:-1]]))
+    return maximum(distances - radii, 0)
+
+
 class RelationSet(object):
     def __init__(self):
         pass
@@ -52,7 +70,11 @@ class Measurement(object):
     }
 
     def __init__(self, distance, required=True, distance_class=None, degree_class=None):
+        self.set_classes(required, distance_class, degree_class)
+        self.distance = distance
+        self.set_best( self.evaluate_all() )
 
+    def set_classes(self, required, distance_class, degree_class):
         self.distance_classes = Measurement.distance_classes.copy()
         if distance_class is not None:
             self.distance_classes = { distance_class: self.distance_classes[distance_class] }
@@ -65,8 +87,9 @@ class Measurement(object):
             self.degree_classes = { degree_class: self.degree_classes[degree_class] }
 
         self.required = required
-        self.distance = distance
-        self.best = self.evaluate_all()
+
+    def set_best(self, best):
+        self.best = best
         self.best_distance_class = self.best[2]
 
         if self.best_distance_class == Measurement.NONE:
@@ -100,6 +123,71 @@ class Measurement(object):
         index = ps.cumsum().searchsorted( random.sample(1) )[0]
         return probs[index]
 
+    @staticmethod
+    def get_random_state(random_state=None):
+        ''' None for the shared generator, an int seed or a numpy RandomState '''
+        if random_state is None:
+            return random
+        if isinstance(random_state, RandomState):
+            return random_state
+        return RandomState(random_state)
+
+    @staticmethod
+    def sample_batch(distances, required=True, distance_class=None, degree_class=None, random_state=None):
+        ''' Draws the best classes of Measurement(distance, required, distance_class, degree_class)
+            for every distance in one vectorized step. Classes are enumerated in Measurement.all and
+            Degree.all order, so draws follow the distribution of evaluate_all but not its sequence.
+            Returns (probabilities, degree_classes, distance_classes) arrays, i.e. Measurement.best
+            for every distance. '''
+        probe = Measurement.__new__(Measurement)
+        probe.set_classes(required, distance_class, degree_class)
+        dist_classes = [c for c in Measurement.all if c in probe.distance_classes]
+        deg_classes = [c for c in Degree.all if c in probe.degree_classes]
+
+        epsilon = 1e-6
+        distances = asarray(distances, dtype=float).ravel()
+        ps = Measurement.get_applicability_tensor(distances, dist_classes, deg_classes).reshape(-1, len(distances)) + epsilon
+
+        # inverse CDF draw per distance: index of the first cumulative probability >= u
+        cdf = ps.cumsum(axis=0)
+        cdf /= cdf[-1]
+        u = Measurement.get_random_state(random_state).random_sample(len(distances))
+        indices = minimum( (cdf < u).sum(axis=0), len(ps) - 1 )
+
+        degrees = array(deg_classes, dtype=object)[indices % len(deg_classes)]
+        dists = array(dist_classes, dtype=object)[indices // len(deg_classes)]
+        degrees[dists == Measurement.NONE] = Degree.NONE
+        return ps[indices, range(len(distances))], degrees, dists
+
+    @classmethod
+    def batch(cls, distances, required=True, distance_class=None, degree_class=None, random_state=None):
+        ''' Measurement(distance, required, distance_class, degree_class) for every distance,
+            sampled with sample_batch. Returns a list of Measurements. '''
+        ps, degrees, dists = cls.sample_batch(distances, required, distance_class, degree_class, random_state)
+
+        measurements = []
+        for distance,best in zip(distances, zip(ps.tolist(), degrees.tolist(), dists.tolist())):
+            measurement = cls.__new__(cls)
+            measurement.set_classes(required, distance_class, degree_class)
+            measurement.distance = distance
+            measurement.set_best( list(best) )
+            measurements.append(measurement)
+
+        return measurements
+
+    @staticmethod
+    def get_sampled_applicability(distances, distance_classes, degree_classes):
+        ''' get_applicability with a distance and degree class per distance, such as the
+            classes drawn by sample_batch '''
+        distances = asarray(distances, dtype=float)
+        ps = zeros(distances.shape)
+        for dist in set(distance_classes):
+            for degree in set(degree_classes):
+                mask = (distance_classes == dist) & (degree_classes == degree)
+                if mask.any():
+                    ps[mask] = Measurement.get_applicability(distances[mask], dist, degree)
+        return ps
+
     def __repr__(self):
         return 'Measurement< req: %i, bdegree: %s, bdistance: %s >' % (self.required, self.best_degree_class, self.best_distance_class)
 
@@ -114,28 +202,72 @@ class Measurement(object):
         if sign < 0: ps = 1 - ps
         return ps
 
+    @staticmethod
+    def get_applicability_tensor(distances, distance_classes=None, degree_classes=None):
+        ''' get_applicability for every (distance class, degree class) pair from a single
+            broadcasted CDF evaluation. Classes default to Measurement.all and Degree.all,
+            returns an array shaped [distance_class, degree_class] + distances.shape '''
+        if distance_classes is None: distance_classes = Measurement.all
+        if degree_classes is None: degree_classes = Degree.all
+
+        distances = asarray(distances, dtype=float)
+        params = array([Measurement.distance_classes[c] for c in distance_classes], dtype=float)
+        mults = array([Measurement.degree_classes[c] for c in degree_classes], dtype=float)
+
+        shape = (len(distance_classes), 1) + (1,)*distances.ndim
+        mu, std, sign = [params[:,i].reshape(shape) for i in range(3)]
+        means = mu * mults.reshape((1, len(degree_classes)) + (1,)*distances.ndim) ** sign
+
+        ps = norm.cdf(distances, means, std)
+        return where(sign < 0, 1 - ps, ps)
+
     @staticmethod
     def any_are_applicable(distances, required=False):
-        dist_classes = Measurement.distance_classes.copy()
+        dist_classes = list(Measurement.all)
         if required:
-            del dist_classes[Measurement.NONE]
-        deg_classes = Measurement.degree_classes
+            dist_classes.remove(Measurement.NONE)
 
         # Get the best probability across all degrees and distances TODO: not?
-        last = zeros(distances.shape)
-        for distc,degc in product(dist_classes.keys(), deg_classes.keys()):
-            ps = Measurement.get_applicability(distances, distc, degc)
-            last = maximum(ps,last)
-
-        return last
+        return Measurement.get_applicability_tensor(distances, dist_classes).max(axis=(0,1))
 
 
 class DistanceRelation(Relation):
+    distance_class = None
+
     def __init__(self, perspective, landmark, trajector):
         super(DistanceRelation, self).__init__(perspective, landmark, trajector)
         self.distance = self.landmark.distance_to(self.trajector.representation)
         self.measurement = Measurement(self.distance)
 
+    @classmethod
+    def batch(cls, perspective, landmark, trajectors, random_state=None):
+        ''' cls(perspective, landmark, trajector) for every trajector, with distances and
+            measurements computed in one vectorized pass '''
+        distances = trajector_distances(landmark, trajectors)
+        measurements = Measurement.batch(distances, distance_class=cls.distance_class, random_state=random_state)
+
+        relations = []
+        for trajector,distance,measurement in zip(trajectors, distances, measurements):
+            relation = cls.__new__(cls)
+            Relation.__init__(relation, perspective, landmark, trajector)
+            relation.distance = distance
+            relation.measurement = measurement
+            relations.append(relation)
+        return relations
+
+    @classmethod
+    def batch_is_applicable(cls, perspective, landmark, trajectors, random_state=None):
+        ''' is_applicable of cls.batch(perspective, landmark, trajectors) as an array, without
+            building the relations '''
+        if isinstance(landmark.representation, SurfaceRepresentation):
+            return zeros( len(trajectors) )
+
+        distances = trajector_distances(landmark, trajectors)
+        _, degrees, dists = Measurement.sample_batch(distances, distance_class=cls.distance_class, random_state=random_state)
+        ps = Measurement.get_sampled_applicability(distances, dists, degrees)
+        ps[trajectors_contained(landmark, trajectors)] = 0.0
+        return ps
+
     def is_applicable(self):
         if not (self.landmark.representation.contains( self.trajector.representation )
            or isinstance(self.landmark.representation, SurfaceRepresentation)):
@@ -143,16 +275,24 @@ class DistanceRelation(Relation):
         else:
             return 0.0
 
-    def are_applicable(self, point_array):
-        distances = zeros( point_array.shape[0] )
-
+    def are_applicable(self, point_array, distances=None):
         if isinstance(self.landmark.representation, SurfaceRepresentation):
-            return distances #return zeros
+            return zeros( point_array.shape[0] )
 
-        for i,point in enumerate(point_array):
-            distances[i] = self.landmark.distance_to_point(point)
+        if distances is None:
+            distances = self.landmark.distance_to_points(point_array)
         return self.measurement.are_applicable(distances)
 
+    def are_applicable_tensor(self, point_array, distances=None):
+        ''' are_applicable for every (distance class, degree class) of the measurement at once,
+            shaped [Measurement.all, Degree.all, N] '''
+        if isinstance(self.landmark.representation, SurfaceRepresentation):
+            return zeros( (len(Measurement.all), len(Degree.all), point_array.shape[0]) )
+
+        if distances is None:
+            distances = self.landmark.distance_to_points(point_array)
+        return Measurement.get_applicability_tensor(distances)
+
     def __hash__(self):
         return hash(self.__class__.__name__ + ' ' + self.measurement.__hash__())
 
@@ -160,20 +300,23 @@ class DistanceRelation(Relation):
         return cmp(self.__hash__(), other.__hash__())
 
     @classmethod
-    def any_are_applicable(cls, perspective, landmark, point_array):
-        distances = zeros( point_array.shape[0] )
-        for i,point in enumerate(point_array):
-            distances[i] = landmark.distance_to_point(point)
+    def any_are_applicable(cls, perspective, landmark, point_array, distances=None):
+        if distances is None:
+            distances = landmark.distance_to_points(point_array)
         return Measurement.any_are_applicable(distances, required=True)
 
 
 class FromRelation(DistanceRelation):
+    distance_class = Measurement.FAR
+
     def __init__(self, perspective, landmark, trajector):
         super(FromRelation, self).__init__(perspective, landmark, trajector)
         self.measurement = Measurement(distance=self.distance, distance_class=Measurement.FAR)
 
 
 class ToRelation(DistanceRelation):
+    distance_class = Measurement.NEAR
+
     def __init__(self, perspective, landmark, trajector):
         super(ToRelation, self).__init__(perspective, landmark, trajector)
         self.measurement = Measurement(distance=self.distance, distance_class=Measurement.NEAR)
@@ -198,7 +341,7 @@ class ContainmentRelation(Relation):
         return float(self.landmark.representation.contains( self.trajector.representation ))
 
     def are_applicable(self, point_array):
-        return array( [float(self.landmark.representation.contains_point( point )) for point in point_array] )
+        return self.landmark.representation.contains_points( point_array ).astype(float)
 
     def __hash__(self):
         return hash(self.__class__.__name__)
@@ -208,7 +351,12 @@ class ContainmentRelation(Relation):
 
     @classmethod
     def any_are_applicable(cls, perspective, landmark, point_array):
-        return array( [float(landmark.representation.contains_point( point )) for point in point_array] )
+        return landmark.representation.contains_points( point_array ).astype(float)
+
+    @classmethod
+    def batch_is_applicable(cls, perspective, landmark, trajectors, random_state=None):
+        ''' is_applicable of cls(perspective, landmark, trajector) for every trajector as an array '''
+        return trajectors_contained(landmark, trajectors).astype(float)
 
 class OnRelation(ContainmentRelation):
     def __init__(self, perspective, landmark, trajector):
@@ -217,11 +365,12 @@ class OnRelation(ContainmentRelation):
 
 class OrientationRelation(Relation):
     orientation = None
+    ray_cache = LRUCache(maxsize=4096)
 
     def __init__(self, perspective, landmark, trajector):
         super(OrientationRelation, self).__init__(perspective, landmark, trajector)
 
-        self.ori_ray = OrientationRelation.get_orientation_ray(perspective, landmark)
+        self.ori_ray = self.get_orientation_ray(perspective, landmark)
 
         # TODO make sure this works using .middle
         if landmark.parent is not None:
@@ -233,8 +382,60 @@ class OrientationRelation(Relation):
         self.distance = self.ori_ray.start.distance_to(self.projected)
         self.measurement = Measurement(self.distance, required=False, distance_class=Measurement.FAR)
 
+    @classmethod
+    def batch(cls, perspective, landmark, trajectors, random_state=None):
+        ''' cls(perspective, landmark, trajector) for every trajector, sharing one orientation ray
+            and projecting and measuring all trajectors in one vectorized pass '''
+        ori_ray, along, projected = cls.get_trajector_offsets(perspective, landmark, trajectors)
+
+        distances = abs(along)
+        measurements = Measurement.batch(distances, required=False, distance_class=Measurement.FAR, random_state=random_state)
+
+        relations = []
+        for trajector,point,distance,measurement in zip(trajectors, projected, distances, measurements):
+            relation = cls.__new__(cls)
+            Relation.__init__(relation, perspective, landmark, trajector)
+            relation.ori_ray = ori_ray
+            relation.projected = Vec2(*point)
+            relation.distance = distance
+            relation.measurement = measurement
+            relations.append(relation)
+        return relations
+
+    @classmethod
+    def get_trajector_offsets(cls, perspective, landmark, trajectors):
+        ''' The orientation ray and, for every trajector, the offset along it and the point it
+            projects to, as computed in __init__ '''
+        ori_ray = cls.get_orientation_ray(perspective, landmark)
+
+        middles = vecs_to_array([trajector.representation.middle for trajector in trajectors])
+        if landmark.parent is not None:
+            middles = landmark.parent.project_points(middles)
+        along, projected = cls.project_onto_ray(ori_ray, middles)
+        return ori_ray, along, projected
+
+    @classmethod
+    def batch_is_applicable(cls, perspective, landmark, trajectors, random_state=None):
+        ''' is_applicable of cls.batch(perspective, landmark, trajectors) as an array, without
+            building the relations '''
+        ori_ray, along, projected = cls.get_trajector_offsets(perspective, landmark, trajectors)
+        distances = abs(along)
+        _, degrees, dists = Measurement.sample_batch(distances, required=False, distance_class=Measurement.FAR, random_state=random_state)
+
+        applies = (along > -EPSILON) & ~landmark.representation.contains_points(projected)
+        return Measurement.get_sampled_applicability(distances, dists, degrees)*applies
+
     @classmethod
     def get_orientation_ray(cls, perspective, landmark):
+        ''' Memoized compute_orientation_ray, keyed on the perspective coordinates, landmark
+            identity and orientation vector. Hit/miss counts are in ray_cache.stats() '''
+        orientation = cls.orientation
+        key = (perspective.x, perspective.y, landmark.uuid, orientation.x, orientation.y)
+        return OrientationRelation.ray_cache.get(key,
+            lambda: OrientationRelation.compute_orientation_ray(perspective, landmark, orientation))
+
+    @staticmethod
+    def compute_orientation_ray(perspective, landmark, orientation):
 
         standard_direction = Vec2(0,1)
 
@@ -253,7 +454,7 @@ class OrientationRelation(Relation):
 
         angle = standard_direction.angle_to(p_segment.vector)
         rotation = Affine.rotation(angle)
-        o = [cls.orientation]
+        o = [orientation]
         rotation.itransform(o)
         direction = o[0]
         ori_ray = Ray(p_segment.end, direction)
@@ -267,17 +468,32 @@ class OrientationRelation(Relation):
         else:
             return 0.0
 
+    @staticmethod
+    def project_onto_ray(ori_ray, point_array):
+        ''' Projects points onto the line of ori_ray. Returns the signed offsets from the ray start
+            along its direction and the projected points '''
+        start = array(ori_ray.start)
+        direction = array(ori_ray.direction) / ori_ray.direction.length
+        along = ((vecs_to_array(point_array) - start)*direction).sum(axis=1)
+        return along, start + along[:,None]*direction
+
+    def get_ray_distances(self, point_array):
+        ''' Returns distances along the orientation ray and the mask of points it applies to '''
+        along, projected = self.project_onto_ray(self.ori_ray, point_array)
+        # a projected point is on the ray unless it lies behind the start
+        applies = (along > -EPSILON) & ~self.landmark.representation.contains_points(projected)
+        return abs(along), applies.astype(float)
+
     def are_applicable(self, point_array):
-        applies = zeros( point_array.shape[0] )
-        for i,point in enumerate(point_array):
-            point = self.ori_ray.line.project(point)
-            applies[i] = self.ori_ray.contains_point(point) and not \
-                         self.landmark.representation.contains_point(point)
-        distances = zeros( point_array.shape[0] )
-        for i,point in enumerate(point_array):
-            distances[i] = self.ori_ray.start.distance_to(self.ori_ray.line.project(point))
+        distances, applies = self.get_ray_distances(point_array)
         return self.measurement.are_applicable(distances)*applies
 
+    def are_applicable_tensor(self, point_array, distances=None):
+        ''' are_applicable for every (distance class, degree class) of the measurement at once,
+            shaped [Measurement.all, Degree.all, N] '''
+        distances, applies = self.get_ray_distances(point_array)
+        return Measurement.get_applicability_tensor(distances)*applies
+
     def __hash__(self):
         return hash(self.__class__.__name__ + ' ' + self.measurement.__hash__())
 
@@ -287,38 +503,24 @@ class OrientationRelation(Relation):
     @classmethod
     def any_are_applicable(cls, perspective, landmark, point_array):
         ori_ray = cls.get_orientation_ray(perspective, landmark)
-        distances = zeros( point_array.shape[0] )
-        for i,point in enumerate(point_array):
-            distances[i] = ori_ray.start.distance_to(ori_ray.line.project(point))
-        return Measurement.any_are_applicable(distances)
+        along, projected = cls.project_onto_ray(ori_ray, point_array)
+        return Measurement.any_are_applicable(abs(along))
 
 
 class InFrontRelation(OrientationRelation):
     orientation = Vec2(0,-1)
-    def __init__(self, perspective, landmark, trajector):
-        OrientationRelation.orientation = Vec2(0,-1)
-        super(InFrontRelation, self).__init__(perspective, landmark, trajector)
 
 
 class BehindRelation(OrientationRelation):
     orientation = Vec2(0,1)
-    def __init__(self, perspective, landmark, trajector):
-        OrientationRelation.orientation = Vec2(0,1)
-        super(BehindRelation, self).__init__(perspective, landmark, trajector)
 
 
 class LeftRelation(OrientationRelation):
     orientation = Vec2(-1,0)
-    def __init__(self, perspective, landmark, trajector):
-        OrientationRelation.orientation = Vec2(-1,0)
-        super(LeftRelation, self).__init__(perspective, landmark, trajector)
 
 
 class RightRelation(OrientationRelation):
     orientation = Vec2(1,0)
-    def __init__(self, perspective, landmark, trajector):
-        OrientationRelation.orientation = Vec2(1,0)
-        super(RightRelation, self).__init__(perspective, landmark, trajector)
 
 
 class DistanceRelationSet(RelationSet):
@@ -392,9 +594,35 @@ class OrientationRelationSet(RelationSet):
         for rel in class_.relations:
             rel_instance = rel(perspective, sampled_landmark, trajector)
             if not use_distance:
-                rel_instance.measurement.best_distance = Measurement.NONE
-                rel_instance.measurement.best_degree = Degree.NONE
+                rel_instance.measurement.best_distance_class = Measurement.NONE
+                rel_instance.measurement.best_degree_class = Degree.NONE
             if rel_instance.is_applicable():
                 rels.append(rel_instance)
 
         return rels
+
+    @classmethod
+    def get_orientation_modifiers(class_, perspective, landmark):
+        ''' Orientation relation classes describing where landmark lies within its parent
+            landmark, leaving out those its parent landmark already has within its own parent '''
+        options = set()
+        if landmark.parent and landmark.parent.parent_landmark:
+            middle_lmk = Landmark('', PointRepresentation(landmark.parent.middle), landmark.parent, None)
+            options = class_.get_applicable_relations(perspective,
+                                                      middle_lmk,
+                                                      Landmark( None,
+                                                                PointRepresentation(landmark.representation.middle),
+                                                                None, None),
+                                                      use_distance=False)
+
+            par_lmk = landmark.parent.parent_landmark
+            if par_lmk.parent and par_lmk.parent.parent_landmark:
+                par_middle_lmk = Landmark('', PointRepresentation(par_lmk.parent.middle), par_lmk.parent, None)
+                trajector = Landmark('', PointRepresentation(par_lmk.representation.middle), None, None)
+                par_options = class_.get_applicable_relations(perspective, par_middle_lmk, trajector, use_distance=False)
+            else:
+                par_options = []
+
+            options = sorted(set(options).difference(set(par_options)))
+
+        return tuple(map(type, options))
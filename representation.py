@@ -1,4 +1,5 @@
 import json
+import planar
 from planar import Vec2
 from planar import BoundingBox
 from planar import Polygon
@@ -11,11 +12,29 @@ from landmark import Landmark
 from geometry import (
     Circle,
     seg_to_seg_distance,
-    poly_to_edges,
     poly_to_vec_distance,
+    verts_to_vecs_distance,
     poly_to_seg_distance,
+    poly_to_segs_array,
+    poly_contains_vecs,
+    segs_to_segs_min_distance,
+    shape_to_segs_array,
+    seg_to_vecs_distance,
+    segs_to_vecs_distance,
+    seg_project_vecs,
+    vec_to_vecs_distance,
+    vecs_to_array,
+    POINT,
+    LINE,
+    RECT,
+    CIRCLE,
+    POLYGON,
     bb_to_bb_distance,
-    poly_to_poly_distance
+    bb_to_vec_distance,
+    bb_to_vecs_distance,
+    bb_contains_vecs,
+    bb_project_vec,
+    bb_project_vecs
 )
 
 from serialize import (
@@ -43,7 +62,7 @@ class AbstractRepresentation(object):
         raise NotImplementedError
 
     def get_alt_representations(self):
-        result = self.alt_representations
+        result = list(self.alt_representations)
 
         for al in self.alt_representations:
             result.extend(al.get_alt_representations())
@@ -53,6 +72,19 @@ class AbstractRepresentation(object):
     def get_points(self):
         raise NotImplementedError
 
+    def get_point_array(self):
+        ''' get_points as an (N,2) array '''
+        return vecs_to_array(self.get_points())
+
+    def get_distance_points(self):
+        ''' (points, radius) such that the distance to this representation is the distance to
+            the closest of points minus radius, clamped at 0 '''
+        return self.get_point_array(), 0.0
+
+    def get_packed_geometry(self):
+        ''' Returns (kind, coords, vertices) as used by geometry.packed_to_vecs_distance '''
+        raise NotImplementedError
+
     def project_point(self, point):
         if self.parent_landmark is None or self.parent_landmark.parent is None:
             return self.my_project_point(point)
@@ -62,10 +94,24 @@ class AbstractRepresentation(object):
     def my_project_point(self, point):
         raise NotImplementedError
 
+    def project_points(self, points):
+        ''' Batch project_point, takes (N,2) array, returns (N,2) array '''
+        if self.parent_landmark is None or self.parent_landmark.parent is None:
+            return self.my_project_points(points)
+        else:
+            return self.parent_landmark.parent.project_points(points)
+
+    def my_project_points(self, points):
+        return vecs_to_array([self.my_project_point(Vec2(*p)) for p in vecs_to_array(points)])
+
     def distance_to(self, rep):
         ''' Takes Representation, returns float '''
         raise NotImplementedError
 
+    def distance_to_points(self, points):
+        ''' Takes (N,2) array, returns array of N distances '''
+        return np.array([self.distance_to_point(Vec2(*p)) for p in vecs_to_array(points)])
+
     def get_landmarks(self, max_level=-1):
         if max_level == 0: return []
         result = self.landmarks.values()
@@ -82,6 +128,10 @@ class AbstractRepresentation(object):
     def contains_point(self, xy):
         raise NotImplementedError
 
+    def contains_points(self, points):
+        ''' Takes (N,2) array, returns boolean mask '''
+        return np.array([self.contains_point(Vec2(*p)) for p in vecs_to_array(points)], dtype=bool)
+
 class PointRepresentation(AbstractRepresentation):
     def __init__(self, point, alt_of=None):
         super(PointRepresentation, self).__init__(alt_of)
@@ -122,6 +172,12 @@ class PointRepresentation(AbstractRepresentation):
     def distance_to_point(self, xy):
         return self.location.distance_to( xy )
 
+    def distance_to_points(self, points):
+        return vec_to_vecs_distance(self.location, points)
+
+    def my_project_points(self, points):
+        return np.zeros( vecs_to_array(points).shape ) + self.location
+
     def contains(self, other):
         ''' If PointRepresentation return True if approx. equal.
             Return False if any other representation. '''
@@ -131,12 +187,18 @@ class PointRepresentation(AbstractRepresentation):
     def contains_point(self, xy):
         return self.location.almost_equals(xy)
 
+    def contains_points(self, points):
+        return vec_to_vecs_distance(self.location, points) < planar.EPSILON
+
     def get_points(self):
         return [self.location]
 
     def get_geometry(self):
         return self.location
 
+    def get_packed_geometry(self):
+        return POINT, (self.location.x, self.location.y, 0, 0), None
+
     def get_primary_axes(self):
         return [Line(self.location, Vec2(1,0)), Line(self.location, Vec2(0,1))]
 
@@ -200,6 +262,12 @@ class LineRepresentation(AbstractRepresentation):
     def distance_to_point(self, xy):
         return self.line.distance_to( xy )
 
+    def distance_to_points(self, points):
+        return seg_to_vecs_distance(self.line, points)
+
+    def my_project_points(self, points):
+        return seg_project_vecs(self.line, points)
+
     def contains(self, other):
         if other.num_dim > self.num_dim: return False
 
@@ -213,9 +281,15 @@ class LineRepresentation(AbstractRepresentation):
     def contains_point(self, xy):
         return self.line.contains_point( xy )
 
+    def contains_points(self, points):
+        return seg_to_vecs_distance(self.line, points) <= planar.EPSILON
+
     def get_geometry(self):
         return self.line
 
+    def get_packed_geometry(self):
+        return LINE, (self.line.start.x, self.line.start.y, self.line.end.x, self.line.end.y), None
+
     def get_points(self):
         return [self.line.start,self.line.end]
 
@@ -224,6 +298,7 @@ class LineRepresentation(AbstractRepresentation):
 
 class CircleRepresentation(AbstractRepresentation):
     def __init__(self, circ, alt_of=None):
+        super(CircleRepresentation, self).__init__(alt_of)
         self.circ = circ
         self.num_dim = 2
         self.middle = circ.center
@@ -252,6 +327,9 @@ class CircleRepresentation(AbstractRepresentation):
     def my_project_point(self, point):
         return point
 
+    def my_project_points(self, points):
+        return vecs_to_array(points)
+
     def distance_to(self, rep):
         geo = rep.get_geometry()
         if isinstance(geo,Vec2):
@@ -263,12 +341,15 @@ class CircleRepresentation(AbstractRepresentation):
         elif isinstance(geo,Polygon):
             distance = poly_to_vec_distance(geo, self.circ.center) - self.circ.radius
         elif isinstance(geo,Circle):
-            self.circ.distance_to(geo.center) - geo.radius
+            distance = self.circ.distance_to(geo.center) - geo.radius
         return distance if distance > 0 else 0
 
     def distance_to_point(self, xy):
         return self.circ.distance_to( xy )
 
+    def distance_to_points(self, points):
+        return self.circ.distances_to( points )
+
     def contains(self, other):
         if other.num_dim > self.num_dim: return False
         if other.num_dim == 0:
@@ -276,18 +357,33 @@ class CircleRepresentation(AbstractRepresentation):
         if other.num_dim == 1:
             return self.circ.contains_point(other.line.start) and self.circ.contains_point(other.line.end)
         if other.num_dim == 2:
-            if isinstance(other,Circle):
+            if isinstance(other,CircleRepresentation):
                 return True if self.circ.center.distance_to(other.circ.center) + other.circ.radius < self.circ.radius else False
-            for p in other.get_points():
-                if not self.circ.contains_point(p): return False
-            return True
+            return bool(self.contains_points(other.get_point_array()).all())
 
     def contains_point(self, xy):
         return self.circ.contains_point( xy )
 
+    def contains_points(self, points):
+        return self.circ.contains_points( points )
+
     def get_geometry(self):
         return self.circ
 
+    def get_points(self):
+        ''' Perimeter samples, for drawing and point-wise checks. Distances to the circle don't
+            use them, see get_distance_points '''
+        return self.circ.get_perimeter_points()
+
+    def get_distance_points(self):
+        return vecs_to_array([self.circ.center]), self.circ.radius
+
+    def get_primary_axes(self):
+        return [Line(self.circ.center, Vec2(1,0)), Line(self.circ.center, Vec2(0,1))]
+
+    def get_packed_geometry(self):
+        return CIRCLE, (self.circ.center.x, self.circ.center.y, self.circ.radius, 0), None
+
 class RectangleRepresentation(AbstractRepresentation):
     def __init__(self, rect=BoundingBox([Vec2(0, 0), Vec2(1, 2)]),
                  landmarks_to_get=['ll_corner','ur_corner','lr_corner','ul_corner',
@@ -300,6 +396,8 @@ class RectangleRepresentation(AbstractRepresentation):
                  alt_of=None):
         super(RectangleRepresentation, self).__init__(alt_of)
         self.rect = rect
+        self._vertices = None
+        self._edges = None
         self.num_dim = 2
         self.middle = rect.center
         self.landmarks_to_get = landmarks_to_get
@@ -406,32 +504,37 @@ class RectangleRepresentation(AbstractRepresentation):
         return json.dumps(self.to_dict())
 
     def my_project_point(self, point):
-        if self.contains_point( point ):
-            return point
-        else:
-            edges = poly_to_edges(self.rect.to_polygon())
-            min_dist = float('inf')
-            for edge in edges:
-                dist = edge.distance_to(point)
-                if dist < min_dist:
-                    min_dist = dist
-                    closest = edge
-            return closest.project(point)
+        return bb_project_vec(self.rect, point)
+
+    def my_project_points(self, points):
+        return bb_project_vecs(self.rect, points)
 
+    def get_vertex_array(self):
+        ''' Polygon vertices of self.rect as an (N,2) array, built once and reused '''
+        if self._vertices is None:
+            self._vertices = vecs_to_array(self.rect.to_polygon())
+        return self._vertices
+
+    def get_edge_array(self):
+        ''' Edges of self.rect as an (N,4) segment array, built once and reused '''
+        if self._edges is None:
+            self._edges = poly_to_segs_array(self.get_vertex_array())
+        return self._edges
 
     def distance_to(self, rep):
         geo = rep.get_geometry()
         if isinstance(geo,Vec2):
-            return poly_to_vec_distance(self.rect.to_polygon(), geo)
-        elif isinstance(geo,LineSegment):
-            return poly_to_seg_distance(self.rect.to_polygon(), geo)
+            return bb_to_vec_distance(self.rect, geo)
+        elif isinstance(geo,LineSegment) or isinstance(geo,Polygon):
+            return segs_to_segs_min_distance(self.get_edge_array(), shape_to_segs_array(geo))
         elif isinstance(geo,BoundingBox):
             return bb_to_bb_distance(self.rect, geo)
-        elif isinstance(geo,Polygon):
-            return poly_to_poly_distance(self.rect.to_polygon(), geo)
 
     def distance_to_point(self, xy):
-        return poly_to_vec_distance( self.rect.to_polygon(), xy )
+        return bb_to_vec_distance( self.rect, xy )
+
+    def distance_to_points(self, points):
+        return bb_to_vecs_distance( self.rect, points )
 
     def contains(self, other):
         if other.num_dim > self.num_dim: return False
@@ -440,18 +543,28 @@ class RectangleRepresentation(AbstractRepresentation):
         if other.num_dim == 1:
             return self.rect.contains_point(other.line.start) and self.rect.contains_point(other.line.end)
         if other.num_dim == 2:
-            for p in other.get_points():
-                if not self.rect.contains_point(p): return False
-            return True
+            if isinstance(other,CircleRepresentation):
+                bounds = other.circ.bounding_box
+                return self.rect.contains_point(bounds.min_point) and self.rect.contains_point(bounds.max_point)
+            return bool(self.contains_points(other.get_point_array()).all())
 
     def contains_point(self, xy):
         return self.rect.contains_point( xy )
 
+    def contains_points(self, points):
+        return bb_contains_vecs( self.rect, points )
+
     def get_geometry(self):
         return self.rect
 
+    def get_packed_geometry(self):
+        return RECT, (self.rect.min_point.x, self.rect.min_point.y, self.rect.max_point.x, self.rect.max_point.y), None
+
     def get_points(self):
-        return list(self.rect.to_polygon())
+        return [Vec2(x,y) for x,y in self.get_vertex_array()]
+
+    def get_point_array(self):
+        return self.get_vertex_array()
 
     def get_primary_axes(self):
         return [Line.from_points([Vec2(self.rect.min_point.x, self.rect.center.y),
@@ -464,6 +577,8 @@ class PolygonRepresentation(AbstractRepresentation):
     def __init__(self, poly, alt_of=None):
         super(PolygonRepresentation, self).__init__(alt_of)
         self.poly = poly
+        self._vertices = None
+        self._edges = None
         self.num_dim = 2
         self.middle = poly.centroid
         self.landmarks = {
@@ -490,19 +605,33 @@ class PolygonRepresentation(AbstractRepresentation):
     def my_project_point(self, point):
         return point
 
+    def get_vertex_array(self):
+        ''' Vertices of self.poly as an (N,2) array, built once and reused '''
+        if self._vertices is None:
+            self._vertices = vecs_to_array(self.poly)
+        return self._vertices
+
+    def get_edge_array(self):
+        ''' Edges of self.poly as an (N,4) segment array, built once and reused '''
+        if self._edges is None:
+            self._edges = poly_to_segs_array(self.get_vertex_array())
+        return self._edges
+
     def distance_to(self, rep):
         geo = rep.get_geometry()
         if isinstance(geo,Vec2):
-            return poly_to_vec_distance(self.poly, geo)
-        elif isinstance(geo,LineSegment):
-            return poly_to_seg_distance(self.poly, geo)
-        elif isinstance(geo,BoundingBox):
-            return poly_to_poly_distance(self.poly, geo.to_polygon())
-        elif isinstance(geo, Polygon):
-            return poly_to_poly_distance(self.poly, geo)
+            return self.distance_to_point(geo)
+        elif isinstance(geo,LineSegment) or isinstance(geo,BoundingBox) or isinstance(geo,Polygon):
+            return segs_to_segs_min_distance(self.get_edge_array(), shape_to_segs_array(geo))
 
     def distance_to_point(self, xy):
-        return poly_to_vec_distance( self.poly, xy )
+        return self.distance_to_points([xy])[0]
+
+    def distance_to_points(self, points):
+        return verts_to_vecs_distance( self.get_vertex_array(), points, self.get_edge_array() )
+
+    def my_project_points(self, points):
+        return vecs_to_array(points)
 
     def contains(self, other):
         if other.num_dim > self.num_dim: return False
@@ -511,18 +640,29 @@ class PolygonRepresentation(AbstractRepresentation):
         if other.num_dim == 1:
             return self.poly.contains_point(other.line.start) and self.poly.contains_point(other.line.end)
         if other.num_dim == 2:
-            for p in other.get_points():
-                if not self.poly.contains_point(p): return False
-            return True
+            if isinstance(other,CircleRepresentation):
+                center = vecs_to_array([other.circ.center])
+                return self.poly.contains_point(other.circ.center) and segs_to_vecs_distance(self.get_edge_array(), center).min() >= other.circ.radius
+            return bool(self.contains_points(other.get_point_array()).all())
 
     def contains_point(self, xy):
         return self.poly.contains_point( xy )
 
+    def contains_points(self, points):
+        return poly_contains_vecs( self.get_vertex_array(), vecs_to_array(points) )
+
     def get_geometry(self):
         return self.poly
 
+    def get_packed_geometry(self):
+        vertices = self.get_vertex_array()
+        return POLYGON, tuple(vertices.min(axis=0)) + tuple(vertices.max(axis=0)), vertices
+
     def get_points(self):
-        return list(self.poly)
+        return [Vec2(x,y) for x,y in self.get_vertex_array()]
+
+    def get_point_array(self):
+        return self.get_vertex_array()
 
     def get_primary_axes(self):
         return []
@@ -1,32 +1,436 @@
-from planar import BoundingBox
+from planar import BoundingBox, Vec2
+from numpy import array, arange, empty, unique, sqrt, zeros, vstack, minimum, column_stack, ones, concatenate, cumsum, tile, meshgrid
+from itertools import product
+from math import floor
+from myrandom import nprandom as random
+from utils import LRUCache
+
+from geometry import (
+    vecs_to_array,
+    packed_to_vecs_distance,
+    packed_project_vecs
+)
+
+
+def bbox_key(bounding_box, step):
+    ''' Hashable key of the grid spanned by a bounding box and step '''
+    return (bounding_box.min_point.x, bounding_box.min_point.y,
+            bounding_box.max_point.x, bounding_box.max_point.y, step)
+
+
+class PointGrid(object):
+    ''' The points spanned by a bounding box and step, ordered like product(xs, ys). Arrays of
+        values over the points reshape to shape, with xs along the first axis. '''
+    def __init__(self, bounding_box, step):
+        self.bounding_box = bounding_box
+        self.step = step
+        self.xs = arange(bounding_box.min_point.x, bounding_box.max_point.x, step)
+        self.ys = arange(bounding_box.min_point.y, bounding_box.max_point.y, step)
+        self.shape = (len(self.xs), len(self.ys))
+        self.points = None
+
+    def __len__(self):
+        return self.shape[0]*self.shape[1]
+
+    def get_points(self):
+        ''' The (N,2) grid points, built the first time they are requested '''
+        if self.points is None:
+            x, y = meshgrid(self.xs, self.ys, indexing='ij')
+            self.points = column_stack( (x.ravel(), y.ravel()) )
+        return self.points
+
+    def cell_edges(self):
+        ''' Lower left corners of the cells centered on the grid points as x and y matrices laid
+            out like to_image, ready for pcolor '''
+        return meshgrid(self.xs - self.step*0.5, self.ys - self.step*0.5)
+
+    def to_grid(self, values, x_slice=None, y_slice=None):
+        ''' values with xs along the first axis, over the whole grid or over the tile that the
+            xs and ys slices of tiles select '''
+        if x_slice is None: return values.reshape(self.shape)
+        return values.reshape( (x_slice.stop - x_slice.start, y_slice.stop - y_slice.start) )
+
+    def to_image(self, values):
+        ''' values with ys along the first axis, as images are indexed '''
+        return values.reshape(self.shape).T
+
+    def tiles(self, tile_size=128):
+        ''' Splits the grid into tiles of at most tile_size by tile_size points. Yields the xs
+            and ys slices of every tile along with its points in product order '''
+        nx, ny = self.shape
+        for i in range(0, nx, tile_size):
+            for j in range(0, ny, tile_size):
+                x_slice = slice(i, min(i+tile_size, nx))
+                y_slice = slice(j, min(j+tile_size, ny))
+                tile_xs = self.xs[x_slice]
+                tile_ys = self.ys[y_slice]
+                yield x_slice, y_slice, column_stack( (tile_xs.repeat(len(tile_ys)), tile(tile_ys, len(tile_xs))) )
+
+
+point_grids = LRUCache(maxsize=64)
+
+def get_point_grid(bounding_box, step):
+    ''' Returns the PointGrid shared by every computation on this (bounding_box, step) grid '''
+    return point_grids.get(bbox_key(bounding_box, step), lambda: PointGrid(bounding_box, step))
+
+
+class DistanceFields(object):
+    ''' Landmark.distance_to_points rasterized over the PointGrid of a bounding box and step.
+        Each landmark's field is computed the first time it is requested and reused afterwards. '''
+    def __init__(self, bounding_box, step):
+        self.bounding_box = bounding_box
+        self.step = step
+        self.grid = get_point_grid(bounding_box, step)
+        self.xs = self.grid.xs
+        self.ys = self.grid.ys
+        self.points = self.grid.get_points()
+        self.fields = {}
+
+    def get(self, landmark):
+        field = self.fields.get(landmark)
+        if field is None:
+            field = landmark.distance_to_points(self.points)
+            self.fields[landmark] = field
+        return field
+
+    def rasterize(self, landmarks):
+        missing = [landmark for landmark in landmarks if landmark not in self.fields]
+        if missing:
+            for landmark,field in zip(missing, GeometryTable(missing).distances_to_points(self.points)):
+                self.fields[landmark] = field
+
+
+class AdaptiveGrid(object):
+    ''' Quadtree refinement of the grid spanned by a bounding box and step.
+
+        The grid is split into square blocks of max_block x max_block grid points (a power of
+        two). evaluate is called on the corner and center points of every block, and a block
+        is accepted with the mean of those values when they spread by at most tolerance.
+        Otherwise it is split into four, down to single grid points, which are exact. Shapes
+        small enough to fall between the samples of a block are given as features, (x0,y0,x1,y1)
+        bounds that every overlapping block is split around until it is at most half their
+        smaller side. Blocks
+        are kept as grid index ranges [lows, highs) with their values, so sum() approximates
+        the sum of evaluate over the full grid. '''
+    def __init__(self, bounding_box, step, evaluate, tolerance=0.01, max_block=16, features=()):
+        self.bounding_box = bounding_box
+        self.step = step
+        self.tolerance = tolerance
+        self.grid = get_point_grid(bounding_box, step)
+        self.xs = self.grid.xs
+        self.ys = self.grid.ys
+        self.evaluations = 0
+
+        nx, ny = self.grid.shape
+        origin = array([bounding_box.min_point.x, bounding_box.min_point.y])
+        features = array(features, dtype=float).reshape(-1,4)
+        blocks = array(list(product(range(0, nx, max_block), range(0, ny, max_block))), dtype=int).reshape(-1,2)
+        size = max_block
+        lows, highs, values = [], [], []
+
+        while len(blocks):
+            last = minimum(blocks + size - 1, [nx-1, ny-1])
+            if size == 1:
+                samples = [blocks]
+            else:
+                samples = [blocks, last, column_stack([blocks[:,0], last[:,1]]), column_stack([last[:,0], blocks[:,1]]), (blocks + last) // 2]
+            samples = vstack(samples)
+            block_values = evaluate( column_stack([self.xs[samples[:,0]], self.ys[samples[:,1]]]) ).reshape(-1, len(blocks))
+            self.evaluations += len(samples)
+
+            if size > 1:
+                done = block_values.max(axis=0) - block_values.min(axis=0) <= tolerance
+                block_min = origin + blocks*step
+                block_max = origin + (last + 1)*step
+                for x0,y0,x1,y1 in features:
+                    if size*step > min(x1 - x0, y1 - y0)/2:
+                        done &= ~( (block_min[:,0] <= x1) & (block_max[:,0] >= x0) & (block_min[:,1] <= y1) & (block_max[:,1] >= y0) )
+            else:
+                done = ones(len(blocks), dtype=bool)
+            lows.append(blocks[done])
+            highs.append(last[done] + 1)
+            values.append(block_values[:,done].mean(axis=0))
+
+            size //= 2
+            split = blocks[~done]
+            blocks = vstack([split, split + [size, 0], split + [0, size], split + [size, size]])
+            blocks = blocks[(blocks[:,0] < nx) & (blocks[:,1] < ny)]
+
+        self.lows = vstack(lows)
+        self.highs = vstack(highs)
+        self.values = concatenate(values)
+        self.counts = (self.highs - self.lows).prod(axis=1)
+
+    def __len__(self):
+        return len(self.values)
+
+    def sum(self):
+        ''' Approximates the sum of evaluate over every point of the uniform grid '''
+        return (self.values*self.counts).sum()
+
+    def sample(self, n=1, jitter=False, random_state=None):
+        ''' Draws n grid points with probability proportional to their block value, optionally
+            jittered uniformly within the step x step cell centered on each point. Returns an
+            (n,2) array of points like PointSampler.sample '''
+        if random_state is None: random_state = random
+        weights = cumsum(self.values*self.counts)
+        blocks = minimum( weights.searchsorted(random_state.random_sample(n)*weights[-1], side='right'), len(weights) - 1 )
+        offsets = (random_state.random_sample((n,2))*(self.highs[blocks] - self.lows[blocks])).astype(int)
+        indices = self.lows[blocks] + offsets
+        points = column_stack([self.xs[indices[:,0]], self.ys[indices[:,1]]])
+        if jitter:
+            points = points + (random_state.random_sample((n,2)) - 0.5)*self.step
+        return points
+
+
+class PointSampler(object):
+    ''' Inverse CDF over the probabilities of a grid of points, spaced step apart. Draws grid
+        points in proportion to their probability, optionally jittered uniformly within the
+        step x step cell centered on each point, as PointGrid.cell_edges draws it. '''
+    def __init__(self, points, probabilities, step):
+        self.points = vecs_to_array(points)
+        self.step = step
+        self.cdf = (probabilities/probabilities.sum()).cumsum()
+
+    def __len__(self):
+        return len(self.points)
+
+    def sample(self, n=1, jitter=False, random_state=None):
+        ''' Returns an (n,2) array of points '''
+        if random_state is None: random_state = random
+        indices = minimum( self.cdf.searchsorted(random_state.random_sample(n)), len(self.cdf) - 1 )
+        points = self.points[indices]
+        if jitter:
+            points = points + (random_state.random_sample((n,2)) - 0.5)*self.step
+        return points
+
+
+def get_projector(representation):
+    ''' The representation whose my_project_point ends up serving representation.project_point '''
+    while representation.parent_landmark is not None and representation.parent_landmark.parent is not None:
+        representation = representation.parent_landmark.parent
+    return representation
+
+
+class GeometryTable(object):
+    ''' Structure-of-arrays view of a list of landmarks.
+
+        Every representation involved is packed once into kinds/coords/starts/ends (polygon
+        vertices live in the shared vertices buffer), see geometry.packed_to_vecs_distance.
+        Row i of shapes, tops, projectors and parents describes landmarks[i]: the packed index
+        of its own representation, of its top parent, of the representation its points are
+        projected on (-1 without a parent) and the row of its parent landmark (-1 if not in
+        the table). '''
+    def __init__(self, landmarks):
+        self.landmarks = list(landmarks)
+        rows = dict((lmk,i) for i,lmk in enumerate(self.landmarks))
+
+        packed = {}
+        kinds = []
+        coords = []
+        starts = []
+        ends = []
+        vertices = [zeros((0,2))]
+
+        def pack(representation):
+            index = packed.get(representation)
+            if index is None:
+                kind, coord, verts = representation.get_packed_geometry()
+                if verts is None: verts = zeros((0,2))
+                index = packed[representation] = len(kinds)
+                start = ends[-1] if ends else 0
+                kinds.append(kind)
+                coords.append(coord)
+                starts.append(start)
+                ends.append(start + len(verts))
+                vertices.append(verts)
+            return index
+
+        self.shapes = []
+        self.tops = []
+        self.projectors = []
+        self.parents = []
+        for lmk in self.landmarks:
+            self.shapes.append( pack(lmk.representation) )
+            self.tops.append( pack(lmk.get_top_parent()) )
+            self.projectors.append( pack(get_projector(lmk.parent)) if lmk.parent else -1 )
+            self.parents.append( rows.get(lmk.parent.parent_landmark, -1) if lmk.parent else -1 )
+
+        self.shapes = array(self.shapes, dtype=int)
+        self.tops = array(self.tops, dtype=int)
+        self.projectors = array(self.projectors, dtype=int)
+        self.parents = array(self.parents, dtype=int)
+        self.kinds = array(kinds, dtype=int)
+        self.coords = array(coords, dtype=float).reshape(-1,4)
+        self.starts = array(starts, dtype=int)
+        self.ends = array(ends, dtype=int)
+        self.vertices = vstack(vertices)
+
+    def __len__(self):
+        return len(self.landmarks)
+
+    def packed_distances(self, indices, points):
+        return packed_to_vecs_distance(self.kinds[indices], self.coords[indices],
+                                       self.starts[indices], self.ends[indices], self.vertices, points)
+
+    def distances_to_points(self, points):
+        ''' Landmark.distance_to_points for every landmark at once, returns (L,N) '''
+        points = vecs_to_array(points)
+
+        tops, top_slots = unique(self.tops, return_inverse=True)
+        tpd = self.packed_distances(tops, points)[top_slots]
+
+        projected = empty( (len(self.landmarks),) + points.shape )
+        projected[:] = points
+        has_projector = self.projectors >= 0
+        if has_projector.any():
+            projectors, slots = unique(self.projectors[has_projector], return_inverse=True)
+            projected[has_projector] = packed_project_vecs(self.kinds[projectors], self.coords[projectors], points)[slots]
+
+        d = self.packed_distances(self.shapes, projected)
+        return sqrt( d*d + tpd*tpd )
+
+
+def representation_bounds(representation):
+    geo = representation.get_geometry()
+    if isinstance(geo, Vec2):
+        return (geo.x, geo.y, geo.x, geo.y)
+    bb = geo.bounding_box
+    return (bb.min_point.x, bb.min_point.y, bb.max_point.x, bb.max_point.y)
+
+
+class LandmarkIndex(object):
+    ''' Uniform grid over landmark bounding boxes. Every landmark is registered in each cell
+        its bounding box overlaps, so containment queries only look at the
+        landmarks in a few cells instead of the whole scene. '''
+    def __init__(self, cell_size=0.1):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.bounds = {}
+        self.order = {}
+        self.counter = 0
+
+    def __len__(self):
+        return len(self.bounds)
+
+    def cell_of(self, x, y):
+        return int(floor(x / self.cell_size)), int(floor(y / self.cell_size))
+
+    def cells_of(self, bounds):
+        min_i, min_j = self.cell_of(bounds[0], bounds[1])
+        max_i, max_j = self.cell_of(bounds[2], bounds[3])
+        return product(range(min_i, max_i+1), range(min_j, max_j+1))
+
+    def insert(self, landmark):
+        bounds = representation_bounds(landmark.representation)
+        self.bounds[landmark] = bounds
+        self.order[landmark] = self.counter
+        self.counter += 1
+        for cell in self.cells_of(bounds):
+            self.cells.setdefault(cell, set()).add(landmark)
+
+    def remove(self, landmark):
+        bounds = self.bounds.pop(landmark)
+        del self.order[landmark]
+        for cell in self.cells_of(bounds):
+            self.cells[cell].discard(landmark)
+            if not self.cells[cell]: del self.cells[cell]
+
+    def sorted(self, landmarks):
+        return sorted(landmarks, key=self.order.__getitem__)
+
+    def containing(self, representation):
+        ''' Landmarks whose representation contains the given representation '''
+        bounds = representation_bounds(representation)
+        candidates = self.cells.get(self.cell_of(bounds[0], bounds[1]), ())
+        return self.sorted([lmk for lmk in candidates
+                            if bounds_contain(self.bounds[lmk], bounds) and lmk.representation.contains(representation)])
+
+    def contained_in(self, representation):
+        ''' Landmarks whose representation is contained in the given representation '''
+        bounds = representation_bounds(representation)
+        candidates = set()
+        for cell in self.cells_of(bounds):
+            candidates.update(self.cells.get(cell, ()))
+        return self.sorted([lmk for lmk in candidates
+                            if bounds_contain(bounds, self.bounds[lmk]) and representation.contains(lmk.representation)])
+
+
+def bounds_contain(outer, inner):
+    return outer[0] <= inner[0] and outer[1] <= inner[1] and outer[2] >= inner[2] and outer[3] >= inner[3]
 
 
 class Scene(object):
-    def __init__(self, num_dim):
+    def __init__(self, num_dim, cell_size=0.1, distance_fields_cache_size=16):
         self.num_dim = num_dim
         self.landmarks = {}
+        self.distance_fields = LRUCache(maxsize=distance_fields_cache_size)
+        self.index = LandmarkIndex(cell_size)
+        self.geometry_tables = {}
+        self.landmark_catalogs = {}
+        self.bounding_box = None
 
     def __repr__(self):
         return 'Scene(' + str(self.num_dim) + ', ' + str(self.landmarks) + ')'
 
     def add_landmark(self, lmk):
+        if lmk.name in self.landmarks:
+            self.index.remove(self.landmarks[lmk.name])
         self.landmarks[lmk.name] = lmk
+        self.index.insert(lmk)
+        self.distance_fields.clear()
+        self.geometry_tables = {}
+        self.landmark_catalogs = {}
+        self.bounding_box = None
 
     def get_child_scenes(self, trajector):
         scenes = []
 
-        for lmk1 in self.landmarks.values():
-            if lmk1.representation.contains(trajector.representation):
-                sc = Scene(lmk1.representation.num_dim)
+        for lmk1 in self.index.containing(trajector.representation):
+            sc = Scene(lmk1.representation.num_dim, self.index.cell_size)
 
-                for lmk2 in self.landmarks.values():
-                    if lmk1.representation.contains(lmk2.representation): sc.add_landmark(lmk2)
+            for lmk2 in self.index.contained_in(lmk1.representation):
+                sc.add_landmark(lmk2)
 
-                scenes.append(sc)
+            scenes.append(sc)
         return scenes
 
+    def get_landmark_catalog(self, max_level=-1):
+        ''' Every landmark of the scene hierarchy down to max_level as (scene landmark, landmark)
+            pairs: each scene landmark paired with itself, followed by the landmarks of its
+            representations paired with it '''
+        catalog = self.landmark_catalogs.get(max_level)
+        if catalog is None:
+            catalog = []
+            for scene_lmk in self.landmarks.values():
+                catalog.append((scene_lmk, scene_lmk))
+
+                representations = [scene_lmk.representation]
+                representations.extend(scene_lmk.representation.get_alt_representations())
+
+                for representation in representations:
+                    catalog.extend([(scene_lmk, lmk) for lmk in representation.get_landmarks(max_level)])
+
+            catalog = tuple(catalog)
+            self.landmark_catalogs[max_level] = catalog
+        return catalog
+
+    def get_geometry_table(self, max_level=-1):
+        ''' GeometryTable over every landmark of the scene hierarchy down to max_level '''
+        table = self.geometry_tables.get(max_level)
+        if table is None:
+            table = GeometryTable([lmk for scene_lmk, lmk in self.get_landmark_catalog(max_level)])
+            self.geometry_tables[max_level] = table
+        return table
+
     def get_bounding_box(self):
-        return BoundingBox.from_shapes([lmk.representation.get_geometry() for lmk in self.landmarks.values()])
+        if self.bounding_box is None:
+            self.bounding_box = BoundingBox.from_shapes([lmk.representation.get_geometry() for lmk in self.landmarks.values()])
+        return self.bounding_box
+
+    def get_distance_fields(self, bounding_box, step):
+        ''' Returns the DistanceFields shared by every computation on this (bounding_box, step) grid '''
+        return self.distance_fields.get(bbox_key(bounding_box, step), lambda: DistanceFields(bounding_box, step))
 
     def fetch_landmark(self, uuid):
         result = None
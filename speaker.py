@@ -6,8 +6,19 @@ from numpy import (
     set_printoptions,
     # random,
     copy as npcopy,
-    exp
+    exp,
+    cumsum,
+    zeros,
+    vstack,
+    minimum,
+    maximum,
+    inf,
+    where,
+    argsort,
+    flatnonzero,
+    float32
 )
+from scipy.sparse import csr_matrix, issparse
 import sys
 sys.path.append("..")
 from myrandom import random
@@ -30,39 +41,77 @@ from representation import (
     SurfaceRepresentation
 )
 
+from geometry import vecs_to_array
+from scene import AdaptiveGrid, PointSampler, representation_bounds, get_point_grid, bbox_key
+
 from relation import (
     DistanceRelationSet,
     ContainmentRelationSet,
     OrientationRelationSet,
     Measurement,
     Degree,
+    DistanceRelation,
+    trajectors_contained,
     ToRelation,
     FromRelation
 )
 
-from utils import categorical_sample, index_max
-
-from multiprocessing import Process, Pipe
-from itertools import izip
-
-def spawn(f):
-    def fun(ppipe, cpipe,x):
-        ppipe.close()
-        cpipe.send(f(x))
-        cpipe.close()
-    return fun
-
-def parmap(f,X):
-    pipe=[Pipe() for x in X]
-    proc=[Process(target=spawn(f),args=(p,c,x)) for x,(p,c) in izip(X,pipe)]
-    [p.start() for p in proc]
-    ret = [p.recv() for (p,c) in pipe]
-    [p.join() for p in proc]
-    return ret
+from utils import categorical_sample, index_max, LRUCache, shared_array
+
+from multiprocessing import Pool, cpu_count
+from itertools import compress
+
+def compact_heatmap(heatmap, storage=None, threshold=0.0):
+    ''' heatmap as generate_all_heatmaps stores it: unchanged for None, as float32 for
+        'float32', or for 'sparse' as a 1 x N scipy.sparse row of the cells above threshold '''
+    if storage is None:
+        return heatmap
+    if storage == 'float32':
+        return heatmap.astype(float32, copy=False)
+    if storage == 'sparse':
+        return csr_matrix( where(heatmap > threshold, heatmap, 0).reshape(1,-1) )
+    raise ValueError('unknown heatmap storage %r' % storage)
+
+def scale_heatmap(heatmap, scale):
+    ''' heatmap*scale for any compact_heatmap format, keeping the format '''
+    if issparse(heatmap):
+        return heatmap.multiply(scale.reshape(1,-1)).tocsr()
+    return heatmap*scale.astype(heatmap.dtype, copy=False)
+
+heatmap_job = None
+
+def init_heatmap_worker(job):
+    ''' Pool initializer of Speaker.generate_relation_heatmaps_pool. job is handed to the worker
+        at fork, so every pool only sees the job it was started for '''
+    global heatmap_job
+    heatmap_job = job
+
+def heatmap_worker(indices):
+    ''' Pool task of Speaker.generate_relation_heatmaps_pool, reading its inputs from the
+        heatmap_job its pool was initialized with. Dense heatmaps are written into the shared
+        arrays of the job, sparse ones are compacted here and returned with their rows '''
+    job = heatmap_job
+    compacted = []
+    for i in indices:
+        relations, heatmaps = job['speaker'].get_relation_probs_for_points(job['points'], job['landmarks'][i], job['landmark_probs'][i],
+                                                                            job['original_landmark_probs'][i], job['perspectives'][i],
+                                                                            job['distance_fields'], job['relations'][i])
+        row = job['rows'][i]
+        for j,(probs,original_probs) in enumerate(heatmaps):
+            if job['storage'] == 'sparse':
+                compacted.append( (row+j, compact_heatmap(probs, 'sparse', job['threshold']),
+                                   compact_heatmap(original_probs, 'sparse', job['threshold'])) )
+            else:
+                job['heatmaps'][row+j] = probs
+                job['original_heatmaps'][row+j] = original_probs
+    return compacted
 
 class Speaker(object):
-    def __init__(self, location):
+    def __init__(self, location, normalizer_cache_size=4096, orientation_cache_size=4096, sampler_cache_size=256):
         self.location = location
+        self.normalizers = LRUCache(maxsize=normalizer_cache_size)
+        self.orientations = LRUCache(maxsize=orientation_cache_size)
+        self.samplers = LRUCache(maxsize=sampler_cache_size)
 
     def get_head_on_viewpoint(self, landmark):
         axes = landmark.get_primary_axes()
@@ -73,79 +122,70 @@ class Speaker(object):
             print "Not getting head on viewpoint!!!"
             return self.location
 
-    def sample_meaning(self, trajector, scene, max_level=-1):
-
+    def sample_meaning(self, trajector, scene, max_level=-1, tolerance=None):
         # scenes = scene.get_child_scenes(trajector) + [scene]
-        scenes = [scene]
-        all_landmarks = []
-
-        for s in scenes:
-            for scene_lmk in s.landmarks.values():
-
-                # Don't want to use the trajector as landmark
-                if scene_lmk == trajector:
-                    continue
-
-                all_landmarks.append([s, scene_lmk])
-
-                representations = [scene_lmk.representation]
-                representations.extend(scene_lmk.representation.get_alt_representations())
-
-                for representation in representations:
-                    for lmk in representation.get_landmarks(max_level):
-                        all_landmarks.append([s, lmk])
-
-        sceness, landmarks = zip( *all_landmarks )
+        # Don't want to use the trajector as landmark
+        landmarks = [lmk for scene_lmk,lmk in scene.get_landmark_catalog(max_level) if scene_lmk != trajector]
 
         sampled_landmark, sl_prob, sl_ent, head_on = self.sample_landmark( landmarks, trajector )
         # print '   ', sampled_landmark, sl_prob, sl_ent
 
-        sampled_relation, sr_prob, sr_ent = self.sample_relation( trajector, scene.get_bounding_box(), head_on, sampled_landmark, step=0.1 )
+        scene_bb = scene.get_bounding_box()
+        sampled_relation, sr_prob, sr_ent = self.sample_relation( trajector, scene_bb, head_on, sampled_landmark, step=0.1,
+                                                                 distance_fields=scene.get_distance_fields(scene_bb, 0.1), tolerance=tolerance )
         # print '   ', sampled_relation, sr_prob, sr_ent
         sampled_relation = sampled_relation( head_on, sampled_landmark, trajector )
 
         return sampled_landmark, sampled_relation, head_on
 
-    def all_meaning_probs(self, trajector, scene, max_level=-1):
+    def all_meaning_probs(self, trajector, scene, max_level=-1, tolerance=None):
         # scenes = scene.get_child_scenes(trajector) + [scene]
-        scenes = [scene]
-        all_landmarks = []
-
-        for s in scenes:
-            for scene_lmk in s.landmarks.values():
-
-                # Don't want to use the trajector as landmark
-                if scene_lmk == trajector:
-                    continue
-
-                all_landmarks.append([s, scene_lmk])
-
-                representations = [scene_lmk.representation]
-                representations.extend(scene_lmk.representation.get_alt_representations())
-
-                for representation in representations:
-                    for lmk in representation.get_landmarks(max_level):
-                        all_landmarks.append([s, lmk])
-
-        sceness, landmarks = zip( *all_landmarks )
+        # Don't want to use the trajector as landmark
+        landmarks = [lmk for scene_lmk,lmk in scene.get_landmark_catalog(max_level) if scene_lmk != trajector]
 
         landmark_probs = self.all_landmark_probs( landmarks, trajector )
+        scene_bb = scene.get_bounding_box()
+        distance_fields = scene.get_distance_fields(scene_bb, 0.1)
         meaning_probs = []
         for lmk,lmk_prob in zip(landmarks,landmark_probs):
             head_on = self.get_head_on_viewpoint( lmk )
-            self.set_orientations(lmk, head_on)
-            for rel_prob,rel_class in zip( *self.all_relation_probs( trajector, scene.get_bounding_box(), head_on, lmk, step=0.1 ) ):
+            for rel_prob,rel_class in zip( *self.all_relation_probs( trajector, scene_bb, head_on, lmk, step=0.1, distance_fields=distance_fields, tolerance=tolerance ) ):
                 rel = rel_class( head_on, lmk, trajector )
                 meaning_probs.append(  ( (lmk,rel), lmk_prob*rel_prob )  )
 
         return meaning_probs
 
-    def describe(self, trajector, scene, visualize=False, max_level=-1, delimit_chunks=False, step=0.01):
+    def all_meaning_probs_batch(self, trajectors, scene, max_level=-1, tolerance=None):
+        ''' all_meaning_probs for many trajectors at once, sharing every trajector independent
+            computation. Returns a [trajector, landmark, relation] array of meaning probabilities
+            with the landmarks and relation classes along its axes. Meanings all_meaning_probs
+            leaves out are 0 '''
+        owners, landmarks = zip( *scene.get_landmark_catalog(max_level) )
+
+        # don't want to use a trajector as landmark
+        excluded = array([[owner == trajector for owner in owners] for trajector in trajectors], dtype=bool)
+        landmark_probs = self.all_landmark_probs_batch(landmarks, trajectors, excluded)
+
+        scene_bb = scene.get_bounding_box()
+        distance_fields = scene.get_distance_fields(scene_bb, 0.1)
+        meaning_probs = None
+        for i,lmk in enumerate(landmarks):
+            head_on = self.get_head_on_viewpoint( lmk )
+            rel_probs, rel_classes = self.all_relation_probs_batch( trajectors, scene_bb, head_on, lmk, step=0.1, distance_fields=distance_fields, tolerance=tolerance )
+            if meaning_probs is None:
+                meaning_probs = zeros( (len(trajectors), len(landmarks), len(rel_classes)) )
+            meaning_probs[:,i] = landmark_probs[:,i,None]*rel_probs
+
+        meaning_probs[excluded] = 0
+        return meaning_probs, landmarks, rel_classes
+
+    def describe(self, trajector, scene, visualize=False, max_level=-1, delimit_chunks=False, step=0.01, tolerance=None):
 
-        sampled_landmark, sampled_relation, head_on = self.sample_meaning(trajector, scene, max_level)
+        sampled_landmark, sampled_relation, head_on = self.sample_meaning(trajector, scene, max_level, tolerance)
 
         vec = trajector.representation.middle
-        description = language_generator.describe(head_on, trajector, sampled_landmark, sampled_relation, delimit_chunks)
+        orientations = self.get_orientations(sampled_landmark, head_on)
+        description = language_generator.describe(head_on, trajector, sampled_landmark, sampled_relation, delimit_chunks, orientations)
         print str(vec) + ' ; ' + description
 
         if visualize: self.visualize(scene, trajector, head_on, sampled_landmark, sampled_relation, description, step)
@@ -154,66 +194,54 @@ class Speaker(object):
     def get_all_meaning_descriptions(self, trajector, scene, sampled_landmark=None, sampled_relation=None, head_on=None, max_level=-1):
         if sampled_landmark is None or sampled_relation is None or head_on is None:
             sampled_landmark, sampled_relation, head_on = self.sample_meaning(trajector, scene, max_level)
-        return language_generator.get_all_descriptions(head_on, trajector, sampled_landmark, sampled_relation)
+        orientations = self.get_orientations(sampled_landmark, head_on)
+        return language_generator.get_all_descriptions(head_on, trajector, sampled_landmark, sampled_relation, orientations=orientations)
 
-    def communicate(self, scene, visualize=False, max_level=-1, delimit_chunks=False):
-        all_landmarks = []
+    def communicate(self, scene, visualize=False, max_level=-1, delimit_chunks=False, tolerance=None):
+        all_landmarks = [lmk for scene_lmk,lmk in scene.get_landmark_catalog(max_level)]
         all_relations = []
 
-        for scene_lmk in scene.landmarks.values():
-            all_landmarks.append(scene_lmk)
-
-            representations = [scene_lmk.representation]
-            representations.extend(scene_lmk.representation.get_alt_representations())
-
-            for representation in representations:
-                all_landmarks.extend(representation.get_landmarks(max_level))
-
         for rset in [DistanceRelationSet,ContainmentRelationSet, OrientationRelationSet]:
             all_relations.extend(rset.relations)
 
         sampled_landmark = choice(all_landmarks)
         sampled_relation = choice(all_relations)
         perspective = self.get_head_on_viewpoint(sampled_landmark)
-        self.set_orientations(sampled_landmark, perspective)
+        orientations = self.get_orientations(sampled_landmark, perspective)
 
         trajector = self.sample_point_trajector( scene.landmarks['table'].representation.get_geometry().bounding_box,
                                                  sampled_relation,
                                                  perspective,
-                                                 sampled_landmark)
+                                                 sampled_landmark,
+                                                 tolerance=tolerance)
 
         print sampled_landmark, self.get_landmark_probability( sampled_landmark, all_landmarks, trajector )
-        print sampled_relation, self.get_relation_probability( sampled_relation, trajector, scene.get_bounding_box(), perspective, sampled_landmark, step=0.1)
+        scene_bb = scene.get_bounding_box()
+        print sampled_relation, self.get_relation_probability( sampled_relation, trajector, scene_bb, perspective, sampled_landmark, step=0.1,
+                                                               distance_fields=scene.get_distance_fields(scene_bb, 0.1), tolerance=tolerance )
 
         sampled_relation = sampled_relation(perspective, sampled_landmark, trajector)
-        description = str(trajector) + '; ' + language_generator.describe(perspective, trajector, sampled_landmark, sampled_relation, delimit_chunks)
+        description = str(trajector) + '; ' + language_generator.describe(perspective, trajector, sampled_landmark, sampled_relation, delimit_chunks, orientations)
         print description
 
         if visualize: self.visualize(scene, trajector, perspective, sampled_landmark, sampled_relation, description, 0.1)
 
-    def set_orientations(self, landmark, perspective):
-        options = set()
-        if landmark.parent and landmark.parent.parent_landmark:
-            middle_lmk = Landmark('', PointRepresentation(landmark.parent.middle), landmark.parent, None)
-            options = OrientationRelationSet.get_applicable_relations(perspective,
-                                                                      middle_lmk,
-                                                                      Landmark( None,
-                                                                                PointRepresentation(landmark.representation.middle),
-                                                                                None, None),
-                                                                      use_distance=False)
-
-            par_lmk = landmark.parent.parent_landmark
-            if par_lmk.parent and par_lmk.parent.parent_landmark:
-                par_middle_lmk = Landmark('', PointRepresentation(par_lmk.parent.middle), par_lmk.parent, None)
-                trajector = Landmark('', PointRepresentation(par_lmk.representation.middle), None, None)
-                par_options = OrientationRelationSet.get_applicable_relations(perspective, par_middle_lmk, trajector, use_distance=False)
-            else:
-                par_options = []
+    def get_orientations(self, landmark, perspective):
+        ''' Orientation modifiers of landmark and of each of its ancestor landmarks seen from
+            perspective, as a dict of relation classes keyed by landmark. Leaves the landmarks untouched '''
+        orientations = {}
+        while landmark is not None:
+            orientations[landmark] = self.get_landmark_orientations(landmark, perspective)
+            landmark = landmark.parent.parent_landmark if landmark.parent else None
+        return orientations
 
-            options = sorted(set(options).difference(set(par_options)))
-            self.set_orientations(par_lmk, perspective)
+    def get_landmark_orientations(self, landmark, perspective):
+        ''' Orientation modifiers of landmark alone, memoized per (landmark, perspective) '''
+        key = (landmark.uuid, perspective.x, perspective.y)
+        return self.orientations.get(key, lambda: self.compute_landmark_orientations(landmark, perspective))
 
-        landmark.ori_relations = map(type, options)
+    def compute_landmark_orientations(self, landmark, perspective):
+        return OrientationRelationSet.get_orientation_modifiers(perspective, landmark)
 
     def talk_to_baby(self, scene, perspectives, how_many_each=10000):
 
@@ -306,30 +334,75 @@ class Speaker(object):
         return reversed(sorted(all_desc))
     '''
 
-    def get_probabilities_box(self, bounding_box, relation, perspective, landmark, step=0.02):
-        xs = arange(bounding_box.min_point.x, bounding_box.max_point.x, step)
-        ys = arange(bounding_box.min_point.y, bounding_box.max_point.y, step)
-        points = array(list(product(xs,ys)))
+    def get_probabilities_box(self, bounding_box, relation, perspective, landmark, step=0.02, distance_fields=None):
+        if distance_fields is not None:
+            points = distance_fields.points
+        else:
+            points = get_point_grid(bounding_box, step).get_points()
 
-        return self.get_probabilities_points(points, relation, perspective, landmark), points
+        return self.get_probabilities_points(points, relation, perspective, landmark, distance_fields), points
 
-    def get_probabilities_points(self, points, relation, perspective, landmark):
+    def get_probabilities_points(self, points, relation, perspective, landmark, distance_fields=None):
         if isinstance(relation,type):
-            probabilities = relation.any_are_applicable(perspective, landmark, points)
+            if distance_fields is not None and issubclass(relation, DistanceRelation):
+                probabilities = relation.any_are_applicable(perspective, landmark, points, distance_fields.get(landmark))
+            else:
+                probabilities = relation.any_are_applicable(perspective, landmark, points)
         else:
-            probabilities = relation.are_applicable(points)
+            if distance_fields is not None and isinstance(relation, DistanceRelation):
+                probabilities = relation.are_applicable(points, distance_fields.get(relation.landmark))
+            else:
+                probabilities = relation.are_applicable(points)
         return probabilities
 
+    def get_probabilities_tiled(self, bounding_box, relation, perspective, landmark, step=0.02, tile_size=128, sink=None):
+        ''' get_probabilities_box one tile of at most tile_size by tile_size points at a time.
+            Every tile is passed to sink(xs slice, ys slice, probabilities) with probabilities
+            shaped like the tile, and the sum over the whole grid is returned '''
+        total = 0.0
+        grid = get_point_grid(bounding_box, step)
+        for x_slice, y_slice, points in grid.tiles(tile_size):
+            probabilities = self.get_probabilities_points(points, relation, perspective, landmark)
+            total += probabilities.sum()
+            if sink is not None:
+                sink(x_slice, y_slice, grid.to_grid(probabilities, x_slice, y_slice))
+        return total
+
+    def get_probabilities_adaptive(self, bounding_box, relation, perspective, landmark, step=0.02, tolerance=0.01):
+        ''' get_probabilities_box on an AdaptiveGrid, refined down to step only where the
+            applicability varies by more than tolerance and around the landmark itself '''
+        return AdaptiveGrid(bounding_box, step, lambda points: self.get_probabilities_points(points, relation, perspective, landmark),
+                            tolerance, features=[representation_bounds(landmark.representation)])
+
     def get_probabilities(self, scene, relation, perspective, landmark, step=0.02):
         scene_bb = scene.get_bounding_box()
         scene_bb = scene_bb.inflate( Vec2(scene_bb.width*0.5,scene_bb.height*0.5) )
-        return self.get_probabilities_box(scene_bb, relation, perspective, landmark, step)
+        return self.get_probabilities_box(scene_bb, relation, perspective, landmark, step, scene.get_distance_fields(scene_bb, step))
+
+    def get_normalizer(self, bounding_box, relation, perspective, landmark, step=0.02, distance_fields=None, tolerance=None):
+        ''' Sum of the relation class applicabilities over the bounding box grid, cached per
+            (relation, perspective, landmark, bounding box, step, tolerance). With a tolerance
+            the sum is approximated on an AdaptiveGrid '''
+        key = (relation, perspective.x, perspective.y, landmark.uuid, bbox_key(bounding_box, step), tolerance)
+        if tolerance is not None:
+            return self.normalizers.get(key,
+                lambda: self.get_probabilities_adaptive(bounding_box, relation, perspective, landmark, step, tolerance).sum())
+        return self.normalizers.get(key,
+            lambda: self.get_probabilities_box(bounding_box, relation, perspective, landmark, step, distance_fields)[0].sum())
+
+    def invalidate_normalizers(self, landmark=None):
+        ''' Drops the cached normalizers and point samplers of landmark, or all of them '''
+        for cache in [self.normalizers, self.samplers]:
+            if landmark is None:
+                cache.invalidate()
+            else:
+                cache.invalidate(lambda key: key[3] == landmark.uuid)
 
-    def evaluate_trajector_likelihood(self, trajector, bounding_box, relation, perspective, landmark, step=0.02):
-        probs, _ = self.get_probabilities_box(bounding_box, relation, perspective, landmark, step)
+    def evaluate_trajector_likelihood(self, trajector, bounding_box, relation, perspective, landmark, step=0.02, distance_fields=None, tolerance=None):
+        normalizer = self.get_normalizer(bounding_box, relation, perspective, landmark, step, distance_fields, tolerance)
         rel = relation( perspective, landmark, trajector )
         trajector_prob = rel.is_applicable()
-        return trajector_prob / (probs.sum() + trajector_prob) if trajector_prob else trajector_prob
+        return trajector_prob / (normalizer + trajector_prob) if trajector_prob else trajector_prob
 
     def all_landmark_probs(self, landmarks, trajector):
         epsilon = 0.02
@@ -351,6 +424,29 @@ class Speaker(object):
         scores = [0 if isinstance(lmk.representation,SurfaceRepresentation) else score for lmk,score in zip(landmarks,scores)]
         return scores/sum(scores)
 
+    def all_landmark_probs_batch(self, landmarks, trajectors, excluded=None):
+        ''' all_landmark_probs for every trajector as a [trajector, landmark] array. Landmarks
+            masked in the boolean [trajector, landmark] array excluded get no probability '''
+        epsilon = 0.02
+        point_arrays, radii = zip(*[lmk.representation.get_distance_points() for lmk in landmarks])
+        counts = array([len(points) for points in point_arrays])
+        lmk_points = vecs_to_array( vstack([points for points in point_arrays if len(points)]) )
+        starts = minimum( cumsum(counts) - counts, len(lmk_points) - 1 )
+
+        distances = array([minimum.reduceat(trajector.distance_to_points(lmk_points), starts) for trajector in trajectors])
+        distances = maximum(distances - radii, 0)
+        distances[:,counts == 0] = inf
+        for i,lmk in enumerate(landmarks):
+            if isinstance(lmk.representation,RectangleRepresentation):
+                distances[trajectors_contained(lmk, trajectors),i] = 9*epsilon
+
+        std = .1
+        scores = exp( -(distances/std)**2)
+        scores[:,[isinstance(lmk.representation,SurfaceRepresentation) for lmk in landmarks]] = 0
+        if excluded is not None:
+            scores[excluded] = 0
+        return scores/scores.sum(axis=1)[:,None]
+
     def sample_landmark(self, landmarks, trajector, usebest=False):
         ''' Weight by inverse of distance to landmark center and choose probabilistically  '''
 
@@ -362,28 +458,33 @@ class Speaker(object):
 
         sampled_landmark = landmarks[index]
         head_on = self.get_head_on_viewpoint(sampled_landmark)
-        self.set_orientations(sampled_landmark, head_on)
 
         return sampled_landmark, lm_probabilities[index], self.get_entropy(lm_probabilities), head_on
 
-    def get_landmark_probs_for_points(self, landmarks, points, xs, ys, x, y):
-
-        def get_probabilities(landmark):
-            epsilon = 0.02
-            distances = array([ landmark.distance_to_point(point)
-                if not (isinstance(landmark.representation,RectangleRepresentation) and landmark.representation.contains_point(point))
-                else 9*epsilon for point in points])
-            # distances = array([ landmark.distance_to_point(point)
-            #     if not (isinstance(landmark.representation,RectangleRepresentation) and landmark.representation.contains_point(point))
-            #     else min(poly_to_vec_distance(landmark.representation.get_geometry().to_polygon(),point),landmark.representation.middle.distance_to(point))
-            #     for point in points])
-            # scores = 1.0/(distances + epsilon)**0.5
-            std = .1
-            scores = exp( -(distances/std)**2)
-            # if scores.sum() != 0:
-            # print landmark, scores.sum(), max(scores)
-            return scores/scores.sum()
-            # else: return scores
+    def get_landmark_heatmap(self, landmark, points, distance_fields=None):
+        distances = distance_fields.get(landmark) if distance_fields is not None else None
+        scores = self.get_landmark_scores(landmark, points, distances)
+        return scores/scores.sum()
+
+    def get_landmark_scores(self, landmark, points, distances=None):
+        ''' Unnormalized landmark heatmap over points. distances are the landmark's distances to
+            points when already known '''
+        epsilon = 0.02
+        if distances is not None:
+            distances = npcopy(distances)
+        else:
+            distances = landmark.distance_to_points(points)
+        if isinstance(landmark.representation,RectangleRepresentation):
+            distances[landmark.representation.contains_points(points)] = 9*epsilon
+        # distances = array([ landmark.distance_to_point(point)
+        #     if not (isinstance(landmark.representation,RectangleRepresentation) and landmark.representation.contains_point(point))
+        #     else min(poly_to_vec_distance(landmark.representation.get_geometry().to_polygon(),point),landmark.representation.middle.distance_to(point))
+        #     for point in points])
+        # scores = 1.0/(distances + epsilon)**0.5
+        std = .1
+        return exp( -(distances/std)**2)
+
+    def get_landmark_probs_for_points(self, landmarks, points, xs, ys, x, y, distance_fields=None):
 
         sum_probs = None
         prob_lists = []
@@ -392,7 +493,7 @@ class Speaker(object):
         syms = ['\\', '|', '/', '-']
 
         for i, landmark in enumerate(landmarks):
-            probs = get_probabilities(landmark)
+            probs = self.get_landmark_heatmap(landmark, points, distance_fields)
             original_probs.append( npcopy(probs) )
             # probabilities = probs.reshape( (len(xs),len(ys)) ).T
             # plt.pcolor(x, y, probabilities, cmap = 'jet', edgecolors='none', alpha=0.7)
@@ -426,41 +527,62 @@ class Speaker(object):
 
         return prob_lists, original_probs
 
-    def get_relation_probs_for_points(self, points, landmark, landmark_heatmap, original_landmark_heatmap, perspective):
-
-        def instantiate_relations(landmark):
+    def instantiate_heatmap_relations(self, landmark, perspective):
+        ''' Relation instances with fixed measurement classes that get a heatmap for landmark '''
 
-            bullshit_trajector = Landmark( None, PointRepresentation( Vec2(0,0) ), None )
-            relations = []
-            if not isinstance(landmark.representation, SurfaceRepresentation):
-                for rel in DistanceRelationSet.relations:
-                    for dist_class, deg_class in list(product([Measurement.NEAR if rel == ToRelation else Measurement.FAR],Degree.all)):
-                        relation = rel( perspective, landmark, bullshit_trajector )
-                        relation.measurement.best_distance_class = dist_class
-                        relation.measurement.best_degree_class = deg_class
-                        relations.append(relation)
-
-            for rel in ContainmentRelationSet.relations:
-                    relation = rel( perspective, landmark, bullshit_trajector )
-                    relations.append(relation)
-
-            for rel in OrientationRelationSet.relations:
-                for dist_class, deg_class in list(product([Measurement.FAR],Degree.all)) + [(Measurement.NONE,Degree.NONE)]:
-                # for dist_class, deg_class in [(Measurement.NONE,Degree.NONE)]:
+        bullshit_trajector = Landmark( None, PointRepresentation( Vec2(0,0) ), None )
+        relations = []
+        if not isinstance(landmark.representation, SurfaceRepresentation):
+            for rel in DistanceRelationSet.relations:
+                for dist_class, deg_class in list(product([Measurement.NEAR if rel == ToRelation else Measurement.FAR],Degree.all)):
                     relation = rel( perspective, landmark, bullshit_trajector )
                     relation.measurement.best_distance_class = dist_class
                     relation.measurement.best_degree_class = deg_class
                     relations.append(relation)
-            return relations
 
+        for rel in ContainmentRelationSet.relations:
+                relation = rel( perspective, landmark, bullshit_trajector )
+                relations.append(relation)
+
+        for rel in OrientationRelationSet.relations:
+            for dist_class, deg_class in list(product([Measurement.FAR],Degree.all)) + [(Measurement.NONE,Degree.NONE)]:
+            # for dist_class, deg_class in [(Measurement.NONE,Degree.NONE)]:
+                relation = rel( perspective, landmark, bullshit_trajector )
+                relation.measurement.best_distance_class = dist_class
+                relation.measurement.best_degree_class = deg_class
+                relations.append(relation)
+        return relations
+
+    def get_relation_applicabilities(self, points, landmark, relations, distances=None):
+        ''' Unnormalized heatmaps of relations about landmark over points. distances are the
+            landmark's distances to points when already known '''
+        heatmaps = []
+        # all measurement variants of a relation class come from one applicability tensor
+        tensors = {}
+        for relation in relations:
+            if hasattr(relation, 'are_applicable_tensor'):
+                rel_class = type(relation)
+                if rel_class not in tensors:
+                    tensors[rel_class] = relation.are_applicable_tensor(points, distances if isinstance(relation, DistanceRelation) else None)
+                probs = npcopy( tensors[rel_class][Measurement.all.index(relation.measurement.best_distance_class),
+                                                   Degree.all.index(relation.measurement.best_degree_class)] )
+            elif distances is not None and isinstance(relation, DistanceRelation):
+                probs = relation.are_applicable(points, distances)
+            else:
+                probs = relation.are_applicable(points)
+            heatmaps.append(probs)
+        return heatmaps
+
+    def get_relation_probs_for_points(self, points, landmark, landmark_heatmap, original_landmark_heatmap, perspective, distance_fields=None, relations=None):
         syms = ['\\', '|', '/', '-']
 
-        relations = instantiate_relations(landmark)
+        if relations is None:
+            relations = self.instantiate_heatmap_relations(landmark, perspective)
         rel_points_probs = []
         original_probs = []
         sum_probs = None
-        for i,relation in enumerate(relations):
-            probs = self.get_probabilities_points(points, relation, None, None)
+        distances = distance_fields.get(landmark) if distance_fields is not None else None
+        for i,probs in enumerate(self.get_relation_applicabilities(points, landmark, relations, distances)):
             if probs.sum() != 0:
                 probs /= probs.sum()
             original_probs.append( npcopy(probs) )
@@ -479,72 +601,176 @@ class Speaker(object):
 
         return relations, zip(rel_points_probs, original_probs)
 
-    def generate_all_heatmaps(self, scene, max_level=1, step=0.02, loi=[None]):
-        scenes = [scene]
+    def generate_all_heatmaps(self, scene, max_level=1, step=0.02, loi=[None], workers=1, chunk_size=4, storage=None, threshold=0.0):
+        ''' Landmark and relation heatmaps over the inflated scene bounding box, once for every
+            landmark in loi left out. Heatmaps are computed once for all landmarks and each left
+            out variant only renormalizes them, sharing the original heatmaps. With workers > 1
+            (None for one per core) the relation heatmaps of chunk_size landmarks at a time are
+            computed by a pool of forked workers, see generate_relation_heatmaps_pool. Relation
+            heatmaps are stored as given by storage, see compact_heatmap. The landmark heatmaps
+            and their sum stay float64 arrays over the whole grid in every storage mode '''
+        if workers is None:
+            workers = cpu_count()
 
         scene_bb = scene.get_bounding_box()
         scene_bb = scene_bb.inflate( Vec2(scene_bb.width*0.5,scene_bb.height*0.5) )
 
-        xs = arange(scene_bb.min_point.x, scene_bb.max_point.x, step)
-        ys = arange(scene_bb.min_point.y, scene_bb.max_point.y, step)
-        points = array(list(product(xs,ys)))
-        x = array( [list(xs-step*0.5)]*len(ys) )
-        y = array( [list(ys-step*0.5)]*len(xs) ).T
-
-        def __generate(lmk_to_exclude=None):
-            all_landmarks = []
-
-            for s in scenes:
-                for scene_lmk in s.landmarks.values():
-                    if scene_lmk == lmk_to_exclude: continue
-
-                    all_landmarks.append([s, scene_lmk])
-
-                    representations = [scene_lmk.representation]
-                    representations.extend(scene_lmk.representation.get_alt_representations())
-
-                    for representation in representations:
-                        for lmk in representation.get_landmarks(max_level):
-                            all_landmarks.append([s, lmk])
-
-            sceness, landmarks = zip( *all_landmarks )
-
-            sys.stdout.write('generating landmark heatmaps sans %s...\\' % lmk_to_exclude)
-            sys.stdout.flush()
-            landmark_probs, original_landmark_probs = self.get_landmark_probs_for_points(landmarks, points, xs, ys, x, y)
-
-            # lmk_rel_dict = {}
+        distance_fields = scene.get_distance_fields(scene_bb, step)
+        points = distance_fields.points
+
+        owners, landmarks = zip( *scene.get_landmark_catalog(max_level) )
+
+        # every landmark's heatmap is computed once, only the normalization depends on the excluded landmark
+        sys.stdout.write('generating landmark heatmaps...\\')
+        sys.stdout.flush()
+        distance_fields.rasterize(landmarks)
+        original_landmark_probs = [self.get_landmark_heatmap(landmark, points, distance_fields) for landmark in landmarks]
+        sum_probs = sum(original_landmark_probs)
+
+        print
+        sys.stdout.write('generating relation heatmaps...\\')
+        sys.stdout.flush()
+        unit_probs = [1.0]*len(landmarks)
+        if workers > 1:
+            lmk_rel_tuples = self.generate_relation_heatmaps_pool(points, landmarks, unit_probs, original_landmark_probs,
+                                                                  distance_fields, workers, chunk_size, storage, threshold)
+        else:
             lmk_rel_tuples = []
-            print
-            sys.stdout.write('generating relation heatmaps sans %s...\\'  % lmk_to_exclude)
-            sys.stdout.flush()
-            for landmark,landmark_prob,original_landmark_prob in zip(landmarks,landmark_probs,original_landmark_probs):
+            for landmark,original_landmark_prob in zip(landmarks,original_landmark_probs):
                 perspective = self.get_head_on_viewpoint(landmark)
-                self.set_orientations(landmark, perspective)
-                # lmk_rel_dict[landmark] = dict( zip(*self.get_relation_probs_for_points(points, landmark, landmark_prob, original_landmark_prob, perspective)) )
-                lmk_rel_tuples.extend( [(landmark, rel, heatmaps) for rel,heatmaps in zip(*self.get_relation_probs_for_points(points, landmark, landmark_prob, original_landmark_prob, perspective))] )
+                relations, heatmaps = self.get_relation_probs_for_points(points, landmark, 1.0, original_landmark_prob, perspective, distance_fields)
+                lmk_rel_tuples.extend( [(landmark, rel, (compact_heatmap(probs, storage, threshold), compact_heatmap(original_probs, storage, threshold)))
+                                        for rel,(probs,original_probs) in zip(relations, heatmaps)] )
                 sys.stdout.write('\b.\\')
                 sys.stdout.flush()
-
-            # def something(llpolp):
-            #     landmark,landmark_prob,original_landmark_prob = llpolp
-            #     perspective = self.get_head_on_viewpoint(landmark)
-            #     self.set_orientations(landmark, perspective)
-            #     # lmk_rel_dict[landmark] = dict( zip(*self.get_relation_probs_for_points(points, landmark, landmark_prob, original_landmark_prob, perspective)) )
-            #     sys.stdout.write('\b.\\')
-            #     return [(landmark, rel, heatmaps) for rel,heatmaps in zip(*self.get_relation_probs_for_points(points, landmark, landmark_prob, original_landmark_prob, perspective))]
-
-            # results = parmap(something, zip(landmarks, landmark_probs, original_landmark_probs))
-            # for result in results:
-            #     lmk_rel_tuples.extend(result)
-            print
-            return lmk_rel_tuples
+        print
 
         result = []
-        for l in loi:
-            result.append(__generate(l))
+        for lmk_to_exclude in loi:
+            keep = [owner != lmk_to_exclude for owner in owners]
+            landmark_probs = dict( zip(compress(landmarks, keep), self.leave_out_landmark_probs(original_landmark_probs, sum_probs, keep)) )
+
+            result.append( [(landmark, rel, (scale_heatmap(probs, landmark_probs[landmark]), original_probs))
+                            for landmark, rel, (probs, original_probs) in lmk_rel_tuples if landmark in landmark_probs] )
+
+        return result, distance_fields.grid.xs, distance_fields.grid.ys
+
+    def generate_all_heatmaps_tiled(self, scene, sink, max_level=1, step=0.02, loi=[None], tile_size=128):
+        ''' generate_all_heatmaps one tile of at most tile_size by tile_size points at a time, so
+            memory is bounded by the tile size instead of the grid size. The heatmap sums that
+            normalize landmarks and relations are accumulated over a first pass through the tiles,
+            the second pass recomputes every tile and calls
+            sink(lmk_to_exclude, landmark, relation, xs slice, ys slice, heatmap, original_heatmap)
+            with heatmaps shaped like the tile. Returns xs and ys of the whole grid '''
+        scene_bb = scene.get_bounding_box()
+        scene_bb = scene_bb.inflate( Vec2(scene_bb.width*0.5,scene_bb.height*0.5) )
+        grid = get_point_grid(scene_bb, step)
+
+        owners, landmarks = zip( *scene.get_landmark_catalog(max_level) )
+        table = scene.get_geometry_table(max_level)
+        relations = [self.instantiate_heatmap_relations(landmark, self.get_head_on_viewpoint(landmark)) for landmark in landmarks]
+
+        def tile_heatmaps(points):
+            distances = table.distances_to_points(points)
+            landmark_scores = [self.get_landmark_scores(landmark, points, dists) for landmark,dists in zip(landmarks, distances)]
+            relation_values = [self.get_relation_applicabilities(points, landmark, rels, dists)
+                               for landmark,rels,dists in zip(landmarks, relations, distances)]
+            return landmark_scores, relation_values
+
+        sys.stdout.write('summing heatmaps...\\')
+        sys.stdout.flush()
+        landmark_sums = zeros(len(landmarks))
+        relation_sums = [zeros(len(rels)) for rels in relations]
+        for x_slice, y_slice, points in grid.tiles(tile_size):
+            landmark_scores, relation_values = tile_heatmaps(points)
+            landmark_sums += [scores.sum() for scores in landmark_scores]
+            for sums,values in zip(relation_sums, relation_values):
+                sums += [probs.sum() for probs in values]
+            sys.stdout.write('\b.\\')
+            sys.stdout.flush()
+        print
+
+        sys.stdout.write('generating heatmaps...\\')
+        sys.stdout.flush()
+        for x_slice, y_slice, points in grid.tiles(tile_size):
+            landmark_scores, relation_values = tile_heatmaps(points)
+            original_landmark_probs = [scores/total for scores,total in zip(landmark_scores, landmark_sums)]
+            sum_probs = sum(original_landmark_probs)
+
+            tile_tuples = []
+            for landmark,rels,values,sums in zip(landmarks, relations, relation_values, relation_sums):
+                original_probs = [probs/total if total != 0 else probs for probs,total in zip(values, sums)]
+                # normalize across relations
+                sum_rel_probs = sum(original_probs)
+                tile_tuples.extend( [(landmark, rel, probs/sum_rel_probs, probs)
+                                     for rel,probs in zip(rels, original_probs)] )
+
+            for lmk_to_exclude in loi:
+                keep = [owner != lmk_to_exclude for owner in owners]
+                landmark_probs = dict( zip(compress(landmarks, keep), self.leave_out_landmark_probs(original_landmark_probs, sum_probs, keep)) )
+                for landmark, rel, probs, original_probs in tile_tuples:
+                    if landmark in landmark_probs:
+                        sink(lmk_to_exclude, landmark, rel, x_slice, y_slice,
+                             grid.to_grid(probs*landmark_probs[landmark], x_slice, y_slice),
+                             grid.to_grid(original_probs, x_slice, y_slice))
+            sys.stdout.write('\b.\\')
+            sys.stdout.flush()
+        print
+
+        return grid.xs, grid.ys
+
+    def leave_out_landmark_probs(self, original_landmark_probs, sum_probs, keep, tolerance=1e-6):
+        ''' Heatmaps of the kept landmarks normalized over the kept landmarks only. The normalizer
+            is sum_probs minus the left out heatmaps, summed directly wherever less than tolerance
+            of sum_probs remains '''
+        kept_probs = list(compress(original_landmark_probs, keep))
+        normalizer = sum_probs - sum( compress(original_landmark_probs, [not k for k in keep]), zeros(sum_probs.shape) )
+
+        cancelled = normalizer < tolerance*sum_probs
+        if cancelled.any():
+            normalizer[cancelled] = sum( [probs[cancelled] for probs in kept_probs], zeros(cancelled.sum()) )
+
+        return [probs/normalizer for probs in kept_probs]
+
+    def generate_relation_heatmaps_pool(self, points, landmarks, landmark_probs, original_landmark_probs, distance_fields, workers, chunk_size, storage=None, threshold=0.0):
+        ''' The relation heatmap loop of generate_all_heatmaps on a worker pool. Relations are
+            instantiated here so measurement sampling follows the serial order. Dense heatmaps
+            are written by every worker into shared arrays of the storage dtype inherited at
+            fork, sparse ones are compacted by the workers a chunk at a time and sent back '''
+        perspectives = [self.get_head_on_viewpoint(landmark) for landmark in landmarks]
+        relations = [self.instantiate_heatmap_relations(landmark, perspective)
+                     for landmark,perspective in zip(landmarks, perspectives)]
+        rows = cumsum([0] + [len(rels) for rels in relations])
+
+        if storage == 'sparse':
+            shared = None, None
+            heatmaps = [None]*rows[-1]
+            original_heatmaps = [None]*rows[-1]
+        else:
+            typecode = 'f' if storage == 'float32' else 'd'
+            shared = heatmaps, original_heatmaps = [shared_array( (rows[-1], len(points)), typecode ) for i in range(2)]
+
+        job = dict( speaker=self, points=points, landmarks=landmarks, landmark_probs=landmark_probs,
+                    original_landmark_probs=original_landmark_probs, perspectives=perspectives,
+                    relations=relations, rows=rows, distance_fields=distance_fields,
+                    heatmaps=shared[0], original_heatmaps=shared[1], storage=storage, threshold=threshold )
+        chunks = [range(i, min(i+chunk_size, len(landmarks))) for i in range(0, len(landmarks), chunk_size)]
+        pool = Pool(workers, initializer=init_heatmap_worker, initargs=(job,))
+        try:
+            for compacted in pool.imap_unordered(heatmap_worker, chunks):
+                for row, probs, original_probs in compacted:
+                    heatmaps[row] = probs
+                    original_heatmaps[row] = original_probs
+                sys.stdout.write('\b.\\')
+                sys.stdout.flush()
+        finally:
+            pool.close()
+            pool.join()
 
-        return result, xs, ys
+        lmk_rel_tuples = []
+        for landmark,rels,row in zip(landmarks, relations, rows):
+            lmk_rel_tuples.extend( [(landmark, rel, (heatmaps[row+j], original_heatmaps[row+j])) for j,rel in enumerate(rels)] )
+        return lmk_rel_tuples
 
 
     def get_landmark_probability(self, sampled_landmark, landmarks, trajector):
@@ -555,18 +781,18 @@ class Speaker(object):
         lm_probabilities = scores/sum(scores)
         return lm_probabilities[ landmarks.index(sampled_landmark) ], self.get_entropy(lm_probabilities)
 
-    def all_relation_probs(self, trajector, bounding_box, perspective, landmark, step=0.02):
+    def all_relation_probs(self, trajector, bounding_box, perspective, landmark, step=0.02, distance_fields=None, tolerance=None):
         rel_scores = []
         rel_classes = []
 
         for s in [DistanceRelationSet, ContainmentRelationSet]:
             for rel in s.relations:
-                rel_scores.append(self.evaluate_trajector_likelihood(trajector, bounding_box, rel, perspective, landmark, step))
+                rel_scores.append(self.evaluate_trajector_likelihood(trajector, bounding_box, rel, perspective, landmark, step, distance_fields, tolerance))
                 rel_classes.append(rel)
 
         ori_rel_scores = []
         for rel in OrientationRelationSet.relations:
-            p = self.evaluate_trajector_likelihood(trajector, bounding_box, rel, perspective, landmark, step)
+            p = self.evaluate_trajector_likelihood(trajector, bounding_box, rel, perspective, landmark, step, distance_fields, tolerance)
             if p > 0: ori_rel_scores.append( (p, rel) )
 
         if len(ori_rel_scores) > 1:
@@ -586,13 +812,50 @@ class Speaker(object):
         rel_scores = array(rel_scores)
         return rel_scores/sum(rel_scores), rel_classes
 
-    def sample_relation(self, trajector, bounding_box, perspective, landmark, step=0.02, usebest=False):
+    def all_relation_probs_batch(self, trajectors, bounding_box, perspective, landmark, step=0.02, distance_fields=None, tolerance=None):
+        ''' all_relation_probs for every trajector as a [trajector, relation] array over a fixed
+            list of relation classes, which is returned with it. Orientation relations that
+            all_relation_probs leaves out are 0 '''
+        rel_classes = DistanceRelationSet.relations + ContainmentRelationSet.relations + OrientationRelationSet.relations
+        rel_scores = zeros( (len(trajectors), len(rel_classes)) )
+
+        for i,rel in enumerate(rel_classes):
+            normalizer = self.get_normalizer(bounding_box, rel, perspective, landmark, step, distance_fields, tolerance)
+            trajector_probs = rel.batch_is_applicable(perspective, landmark, trajectors)
+            applicable = trajector_probs != 0
+            rel_scores[applicable,i] = trajector_probs[applicable] / (normalizer + trajector_probs[applicable])
+
+        ori_rel_scores = rel_scores[:,-len(OrientationRelationSet.relations):]
+        positive = ori_rel_scores > 0
+        counts = positive.sum(axis=1)
+        assert( (counts <= 2).all() )
+        ori_rel_scores[counts < 2] = 0
+
+        # of two applicable orientations the one nearer along its ray is scaled down by the ratio of distances
+        rows = flatnonzero(counts == 2)
+        if len(rows):
+            dists = array([abs(rel.get_trajector_offsets(perspective, landmark, [trajectors[r] for r in rows])[1])
+                           for rel in OrientationRelationSet.relations]).T
+            pairs = argsort(~positive[rows], axis=1, kind='mergesort')[:,:2]
+            index = arange(len(rows))
+            first, second = pairs[:,0], pairs[:,1]
+            first_nearer = (dists[index,first] < dists[index,second]) | \
+                           ((dists[index,first] == dists[index,second]) & (ori_rel_scores[rows,first] <= ori_rel_scores[rows,second]))
+            near = where(first_nearer, first, second)
+            far = where(first_nearer, second, first)
+            ori_rel_scores[rows,near] *= dists[index,near] / dists[index,far]
+
+        rel_probs = rel_scores/rel_scores.sum(axis=1)[:,None]
+        rel_probs[counts < 2,-len(OrientationRelationSet.relations):] = 0
+        return rel_probs, rel_classes
+
+    def sample_relation(self, trajector, bounding_box, perspective, landmark, step=0.02, usebest=False, distance_fields=None, tolerance=None):
         """
         Sample a relation given a trajector and landmark.
         Evaluate each relation and probabilisticaly choose the one that is likely to
         generate the trajector given a landmark.
         """
-        rel_probabilities, rel_classes = self.all_relation_probs(trajector, bounding_box, perspective, landmark, step)
+        rel_probabilities, rel_classes = self.all_relation_probs(trajector, bounding_box, perspective, landmark, step, distance_fields, tolerance)
         if usebest:
             index = index_max(rel_probabilities)
         else:
@@ -602,32 +865,46 @@ class Speaker(object):
 
         return rel_classes[index], rel_probabilities[index], self.get_entropy(rel_probabilities)
 
-    def get_relation_probability(self, sampled_relation, trajector, bounding_box, perspective, landmark, step=0.02):
+    def get_relation_probability(self, sampled_relation, trajector, bounding_box, perspective, landmark, step=0.02, distance_fields=None, tolerance=None):
         rel_scores = []
         rel_classes = []
 
         for s in [DistanceRelationSet, OrientationRelationSet, ContainmentRelationSet]:
             for rel in s.relations:
-                rel_scores.append(self.evaluate_trajector_likelihood(trajector, bounding_box, rel, perspective, landmark, step))
+                rel_scores.append(self.evaluate_trajector_likelihood(trajector, bounding_box, rel, perspective, landmark, step, distance_fields, tolerance))
                 rel_classes.append(rel)
 
         rel_scores = array(rel_scores)
-        set_printoptions(threshold='nan')
+        set_printoptions(threshold=sys.maxsize)
         # print 'X',rel_scores
         rel_probabilities = rel_scores/sum(rel_scores)
         return rel_probabilities[ rel_classes.index(sampled_relation) ], self.get_entropy(rel_probabilities)
 
-    def sample_point_trajector(self, bounding_box, relation, perspective, landmark, step=0.02):
+    def get_point_sampler(self, bounding_box, relation, perspective, landmark, step=0.02, tolerance=None):
+        ''' PointSampler over the relation probabilities on the bounding box grid, cached per
+            (relation, perspective, landmark, bounding box, step, tolerance). With a tolerance
+            the AdaptiveGrid of get_probabilities_adaptive samples instead '''
+        key = (relation, perspective.x, perspective.y, landmark.uuid, bbox_key(bounding_box, step), tolerance)
+        def build():
+            if tolerance is not None:
+                return self.get_probabilities_adaptive(bounding_box, relation, perspective, landmark, step, tolerance)
+            probs, points = self.get_probabilities_box(bounding_box, relation, perspective, landmark, step)
+            return PointSampler(points, probs, step)
+        return self.samplers.get(key, build)
+
+    def sample_point_trajector(self, bounding_box, relation, perspective, landmark, step=0.02, n=None, jitter=False, tolerance=None):
         """
         Sample a point of interest given a relation and landmark.
+        Returns n of them as a list when n is given. With a tolerance the points are drawn
+        from an AdaptiveGrid, see get_probabilities_adaptive.
         """
-        probs, points = self.get_probabilities_box(bounding_box, relation, perspective, landmark)
-        probs /= probs.sum()
-        index = probs.cumsum().searchsorted( random.sample(1) )[0]
-        return Landmark( 'point', Vec2( *points[index] ), None, Landmark.POINT )
+        sampler = self.get_point_sampler(bounding_box, relation, perspective, landmark, step, tolerance)
+        points = sampler.sample(1 if n is None else n, jitter)
+        trajectors = [Landmark( 'point', PointRepresentation( Vec2(*point) ), None, Landmark.POINT ) for point in points]
+        return trajectors[0] if n is None else trajectors
 
     def get_entropy(self, probabilities):
-        probabilities += 1e-15
+        probabilities = probabilities + 1e-15
         probabilities = probabilities/sum(probabilities.flatten())
         return -sum( (probabilities * log(probabilities)).flatten() )
 
@@ -647,8 +924,7 @@ class Speaker(object):
             probabilities, points = self.get_probabilities_box( scene_bb, relation, head_on, sampled_landmark, step )
             # xs, ys = points[:,0], points[:,1]
 
-            xs = arange(scene_bb.min_point.x, scene_bb.max_point.x, step)
-            ys = arange(scene_bb.min_point.y, scene_bb.max_point.y, step)
+            grid = get_point_grid(scene_bb, step)
 
             # probabilities = zeros(  ( len(ys),len(xs) )  )
             # for i,x in enumerate(xs):
@@ -660,13 +936,12 @@ class Speaker(object):
             #         probabilities[j,i] = rel.is_applicable()
             #         # print rel.distance, probabilities[j,i]
 
-            set_printoptions(threshold='nan')
+            set_printoptions(threshold=sys.maxsize)
             #print probabilities
 
-            x = array( [list(xs-step*0.5)]*len(ys) )
-            y = array( [list(ys-step*0.5)]*len(xs) ).T
+            x, y = grid.cell_edges()
 
-            probabilities = probabilities.reshape( (len(xs),len(ys)) ).T
+            probabilities = grid.to_image(probabilities)
 
             # print probabilities
 
@@ -0,0 +1,41 @@
+import unittest
+
+from planar import Vec2, BoundingBox
+
+from landmark import Landmark, ObjectClass
+from representation import RectangleRepresentation
+from relation import InFrontRelation, BehindRelation, LeftRelation, RightRelation
+from speaker import Speaker
+
+
+class OrientationModifierTest(unittest.TestCase):
+    ''' Orientation modifiers only depend on where a landmark lies along the orientation
+        rays of its parent middle, not on a sampled distance class, so the modifiers
+        shared with the parent are always dropped and the order is always the same '''
+    def setUp(self):
+        self.table = Landmark('table', RectangleRepresentation(BoundingBox([Vec2(-3,1), Vec2(3,7)])), None, ObjectClass.TABLE)
+        self.speaker = Speaker(Vec2(0,0))
+
+    def get_modifiers(self, *names):
+        landmark = self.table
+        for name in names:
+            landmark = landmark.representation.landmarks[name]
+        results = set()
+        for i in range(30):
+            results.add(self.speaker.compute_landmark_orientations(landmark, self.speaker.get_head_on_viewpoint(landmark)))
+        return results
+
+    def test_table_parts(self):
+        self.assertEqual(self.get_modifiers('ll_corner'), set([(InFrontRelation, LeftRelation)]))
+        self.assertEqual(self.get_modifiers('ur_corner'), set([(RightRelation, BehindRelation)]))
+        self.assertEqual(self.get_modifiers('n_edge'), set([(InFrontRelation,)]))
+        self.assertEqual(self.get_modifiers('middle'), set([()]))
+
+    def test_nested_parts(self):
+        self.assertEqual(self.get_modifiers('f_surf', 'ul_corner'), set([(LeftRelation,)]))
+        self.assertEqual(self.get_modifiers('l_surf', 'll_corner'), set([(InFrontRelation,)]))
+        self.assertEqual(self.get_modifiers('n_surf', 'n_edge'), set([()]))
+
+
+if __name__ == '__main__':
+    unittest.main()
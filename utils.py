@@ -1,7 +1,64 @@
 from myrandom import nprandom as random
+from collections import OrderedDict
+from threading import Lock
+from multiprocessing.sharedctypes import RawArray
+from numpy import frombuffer, prod, dtype
 
 def categorical_sample(prob_array):
 	return prob_array.cumsum().searchsorted( random.sample(1) )[0]
 
 def index_max(prob_array):
-	return max(enumerate(prob_array), key=lambda x:x[1])[0]
\ No newline at end of file
+	return max(enumerate(prob_array), key=lambda x:x[1])[0]
+
+def shared_array(shape, typecode='d'):
+	''' Zeroed array in shared memory, written by processes forked after its creation. typecode
+	    is a ctypes type code, 'd' for float64 or 'f' for float32 '''
+	return frombuffer(RawArray(typecode, int(prod(shape))), dtype=dtype(typecode)).reshape(shape)
+
+class LRUCache(object):
+	''' Bounded mapping that evicts the least recently used entry and counts hits and misses '''
+	def __init__(self, maxsize=1024):
+		self.maxsize = maxsize
+		self.entries = OrderedDict()
+		self.lock = Lock()
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key, compute):
+		''' Returns the value cached for key, calling compute() to fill it on a miss '''
+		with self.lock:
+			if key in self.entries:
+				self.hits += 1
+				value = self.entries.pop(key)
+				self.entries[key] = value
+				return value
+			self.misses += 1
+
+		value = compute()
+		with self.lock:
+			self.entries[key] = value
+			while len(self.entries) > self.maxsize:
+				self.entries.popitem(last=False)
+		return value
+
+	def invalidate(self, match=None):
+		''' Drops every entry whose key satisfies match(key), or every entry if match is None '''
+		with self.lock:
+			if match is None:
+				self.entries.clear()
+			else:
+				for key in [key for key in self.entries if match(key)]:
+					del self.entries[key]
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+			self.hits = 0
+			self.misses = 0
+
+	def stats(self):
+		with self.lock:
+			return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries), 'maxsize': self.maxsize}
+
+	def __len__(self):
+		return len(self.entries)